@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# extraction.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+# Compare the time taken by each available extraction backend on the
+# archives downloaded into the build directory, or on the archives given on
+# the command line
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import extract
+import fetcher
+
+def backends(fmt):
+    ret = [('tarfile', None)]
+    if shutil.which('tar') is not None:
+        ret.extend((' '.join(cmd), cmd) for cmd in extract.decompressors(fmt))
+    return ret
+
+def time_backend(path, cmd, runs):
+    # Without a command, extract_archive() would still pick a native one
+    # unless it is told to use tarfile
+    saved = extract.backend
+    if cmd is None:
+        extract.backend = 'tarfile'
+    best = None
+    try:
+        for i in range(runs):
+            dest = tempfile.mkdtemp(prefix='bench-',
+                                    dir=os.path.dirname(path))
+            try:
+                start = time.monotonic()
+                extract.extract_archive(path, dest, cmd)
+                elapsed = time.monotonic() - start
+            finally:
+                shutil.rmtree(dest)
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        extract.backend = saved
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive '
+                                     'extraction backends.')
+    parser.add_argument('archives', nargs='*',
+                        help='archives to extract (default: build/*/archive)')
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help='runs per backend, the fastest is reported')
+    args = parser.parse_args()
+    archives = args.archives
+    if not archives:
+        root = os.path.join(os.path.dirname(__file__), '..')
+        archives = sorted(glob.glob(os.path.join(root, 'build', '*',
+                                                 'archive')))
+    if not archives:
+        print('No archives found, run `build.sh fetch\' first.')
+        return 1
+
+    print('%-24s %-6s %-10s %-16s %8s %10s' %
+          ('Archive', 'Format', 'Size', 'Backend', 'Time', 'Rate'))
+    for path in archives:
+        name = os.path.basename(os.path.dirname(path)) \
+            if os.path.basename(path) == 'archive' else os.path.basename(path)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            fmt = extract.detect_format(f.read(8))
+        for backend, cmd in backends(fmt):
+            elapsed = time_backend(path, cmd, args.runs)
+            print('%-24s %-6s %-10s %-16s %7.2fs %8s/s' %
+                  (name, fmt, fetcher.format_size(size), backend, elapsed,
+                   fetcher.format_size(size / elapsed)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# orchestration.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+# Measure the overhead of gnukit itself, separately from compiler time. A
+# synthetic registry of packages that do trivial work is generated in a
+# temporary directory, their archives are served from a local HTTP server,
+# and build.py is run against it in several scenarios. Nothing is fetched
+# from the network.
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import shutil
+import socketserver
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+
+SRC = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+SHAPES = ['chain', 'wide', 'tree', 'random']
+
+PKG_CONF = '''[Package]
+name = %(name)s
+version = 1.0
+build = script
+srcdir = ${name}-${version}
+md5 = %(md5)s
+installed = ${InstallDirs:prefix}/share/bench/${name}
+env = SRCDIR=${srcdir} PREFIX=${InstallDirs:prefix} NAME=${name}
+dependencies = %(deps)s
+
+[URLs]
+url0 = http://127.0.0.1:%(port)d/%(name)s-1.0.tar.gz
+
+[build.script]
+configure = true
+'''
+
+PKG_SCRIPT = '''set -e
+case "$1" in
+    configure) : > configured ;;
+    build) cat ../$SRCDIR/* > /dev/null ;;
+    test) ;;
+    install)
+        mkdir -p "$DESTDIR$PREFIX/share/bench"
+        touch "$DESTDIR$PREFIX/share/bench/$NAME"
+        ;;
+esac
+'''
+
+BUILD_CONF = '''[Packages]
+packages = %(packages)s
+tests = false
+ignore_installed = true
+
+[InstallDirs]
+prefix = %(prefix)s
+
+[Targets]
+
+[Build]
+max_parallel_packages = %(parallel)d
+jobs = %(jobs)d
+source_cache = none
+'''
+
+# Dependencies of each package, by index, for a DAG shape
+def gen_deps(shape, count, max_deps, rng):
+    if shape == 'chain':
+        return [[i - 1] if i else [] for i in range(count)]
+    if shape == 'wide':
+        return [[] for i in range(count)]
+    if shape == 'tree':
+        return [[(i - 1) // 2] if i else [] for i in range(count)]
+    return [sorted(rng.sample(range(i), min(i, rng.randint(0, max_deps))))
+            for i in range(count)]
+
+def gen_archive(name, files, file_size, rng):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as f:
+        for i in range(files):
+            # Half random data so the archive does not compress to nothing
+            half = file_size // 2
+            data = rng.getrandbits(8 * half).to_bytes(half, 'little') + \
+                b'x' * (file_size - half)
+            info = tarfile.TarInfo('%s-1.0/file%d' % (name, i))
+            info.size = len(data)
+            f.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+def gen_tree(root, args, port):
+    rng = random.Random(args.seed)
+    names = ['pkg%04d' % i for i in range(args.packages)]
+    deps = gen_deps(args.shape, args.packages, args.max_deps, rng)
+    for d in ['pkg', 'www']:
+        os.makedirs(os.path.join(root, d))
+    os.symlink(SRC, os.path.join(root, 'src'))
+    for i, name in enumerate(names):
+        data = gen_archive(name, args.files, args.file_size, rng)
+        with open(os.path.join(root, 'www', name + '-1.0.tar.gz'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(root, 'pkg', name + '.conf'), 'w') as f:
+            f.write(PKG_CONF % {
+                'name': name,
+                'md5': hashlib.md5(data).hexdigest(),
+                'deps': ' '.join(names[d] for d in deps[i]),
+                'port': port
+            })
+        with open(os.path.join(root, 'pkg', name + '.sh'), 'w') as f:
+            f.write(PKG_SCRIPT)
+    with open(os.path.join(root, 'build.conf'), 'w') as f:
+        f.write(BUILD_CONF % {
+            'packages': ' '.join(names),
+            'prefix': os.path.join(root, 'prefix'),
+            'parallel': args.parallel,
+            'jobs': args.jobs
+        })
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+# Serves the archives of the directory given to the server, which cannot be
+# passed to SimpleHTTPRequestHandler before Python 3.7
+class ArchiveHandler(http.server.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        name = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        return os.path.join(self.server.directory, os.path.basename(name))
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(directory):
+    server = Server(('127.0.0.1', 0), ArchiveHandler)
+    server.directory = directory
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def reset(root, registry=False):
+    for d in ['build', 'prefix']:
+        path = os.path.join(root, d)
+        if not registry and d == 'build' and os.path.isdir(path):
+            # Keep the registry index but drop every package
+            for name in os.listdir(path):
+                if not name.startswith('registry-'):
+                    p = os.path.join(path, name)
+                    if os.path.isdir(p):
+                        shutil.rmtree(p)
+                    else:
+                        os.unlink(p)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+
+def run_build(root, args, verbose):
+    start = time.monotonic()
+    proc = subprocess.run([sys.executable, os.path.join('src', 'build.py')] +
+                          args, cwd=root, stdin=subprocess.DEVNULL,
+                          stdout=None if verbose else subprocess.DEVNULL,
+                          stderr=subprocess.STDOUT)
+    elapsed = time.monotonic() - start
+    if proc.returncode != 0:
+        raise RuntimeError('build.py %s exited with status %d' %
+                           (' '.join(args), proc.returncode))
+    return elapsed
+
+# Total time spent in each phase over all packages, from the build report
+def phase_times(root):
+    try:
+        with open(os.path.join(root, 'build', 'report.json')) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    ret = {}
+    for entry in report['packages'].values():
+        for record in entry['phases']:
+            ret[record['phase']] = ret.get(record['phase'], 0) + \
+                record['wall']
+    return ret
+
+# Each scenario resets the tree as given, then runs build.py with the given
+# arguments
+SCENARIOS = [
+    ('plan-cold', 'registry', ['plan']),
+    ('plan-warm', None, ['plan']),
+    ('fetch-only', 'packages', ['fetch', '--yes']),
+    ('build-cold', 'packages', ['build', '--yes']),
+    ('build-warm', None, ['build', '--yes']),
+    ('status', None, ['status'])
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gnukit against '
+                                     'a synthetic registry.')
+    parser.add_argument('-p', '--packages', type=int, default=50,
+                        help='number of packages to generate')
+    parser.add_argument('-s', '--shape', choices=SHAPES, default='random',
+                        help='shape of the dependency graph')
+    parser.add_argument('--max-deps', type=int, default=3,
+                        help='most dependencies of a package in a random '
+                        'graph')
+    parser.add_argument('--files', type=int, default=20,
+                        help='number of files in each archive')
+    parser.add_argument('--file-size', type=int, default=16384,
+                        help='size of each file in an archive, in bytes')
+    parser.add_argument('--parallel', type=int, default=4,
+                        help='max_parallel_packages used for the builds')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='jobs used for the builds')
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help='runs per scenario, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the generated registry')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='keep the generated tree')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the output of build.py')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='gnukit-bench-')
+    server = serve(os.path.join(root, 'www'))
+    results = {'packages': args.packages, 'shape': args.shape,
+               'scenarios': {}, 'phases': {}}
+    try:
+        gen_tree(root, args, server.server_address[1])
+        for name, scope, build_args in SCENARIOS:
+            best = None
+            for i in range(args.runs):
+                if scope is not None:
+                    reset(root, scope == 'registry')
+                elapsed = run_build(root, build_args, args.verbose)
+                if best is None or elapsed < best:
+                    best = elapsed
+                    if name == 'build-cold':
+                        results['phases'] = phase_times(root)
+            results['scenarios'][name] = best
+    finally:
+        server.shutdown()
+        if args.keep:
+            print('Generated tree kept in ' + root, file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return 0
+    print('%d packages, %s graph, fastest of %d runs' %
+          (args.packages, args.shape, args.runs))
+    print('\nScenarios')
+    for name, scope, build_args in SCENARIOS:
+        print('  %-24s %8.2fs' % (name, results['scenarios'][name]))
+    print('\nPhases of build-cold, summed over all packages')
+    for phase, wall in sorted(results['phases'].items(),
+                              key=lambda x: x[1], reverse=True):
+        print('  %-24s %8.2fs' % (phase, wall))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,4 +28,4 @@ if [ -z "`$PYTHON --version 2>/dev/null`" ]; then
 fi
 
 cd "`dirname $0`"
-$PYTHON src/build.py
+$PYTHON src/build.py "$@"
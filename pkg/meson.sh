@@ -7,5 +7,5 @@ if [ "$1" = build ]; then
 elif [ "$1" = test ]; then
     true
 elif [ "$1" = install ]; then
-    python3 setup.py install
+    python3 setup.py install --root="${DESTDIR:-/}"
 fi
@@ -7,5 +7,5 @@ elif [ "$1" = test ]; then
     ./ninja ninja_test
     ./ninja_test
 elif [ "$1" = install ]; then
-    install -v -D -m 755 ninja $BINDIR
+    install -v -D -m 755 ninja $DESTDIR$BINDIR/ninja
 fi
@@ -1,13 +1,12 @@
 set -e
 
 [ $# -eq 1 ]
-JOBS=`python3 -c "import multiprocessing; print(multiprocessing.cpu_count())"`
 if [ "$1" = configure ]; then
     ../$SRCDIR/config --prefix=$PREFIX
 elif [ "$1" = build ]; then
-    make `test -n $JOBS && echo -j $JOBS`
+    make
 elif [ "$1" = test ]; then
-    make `test -n $JOBS && echo -j $JOBS` test
+    make test
 elif [ "$1" = install ]; then
     make install
 fi
@@ -16,82 +16,570 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+# Modules only needed by some commands are imported by the functions using
+# them, so that cheap commands such as `status' start quickly
+import argparse
 import config
 import console
-import pkgbuilder
 import os
-import subprocess
 import sys
 
-INSTALLDIRS = [
-    'prefix',
-    'eprefix',
-    'bindir',
-    'sbindir',
-    'libexecdir',
-    'sysconfdir',
-    'sharedstatedir',
-    'localstatedir',
-    'runstatedir',
-    'libdir',
-    'includedir',
-    'datadir',
-    'infodir',
-    'localedir',
-    'mandir',
-    'docdir'
-]
-
-def build_all():
-    build_conf = config.BuildConfig()
+# Exit statuses
+EXIT_OK = 0
+# Packages failed to build or download, or installed files changed
+EXIT_FAILED = 1
+# The command line is invalid
+EXIT_USAGE = 2
+# The installation was not confirmed
+EXIT_CANCELLED = 3
+# Packages remain to be built, for `plan --check' and unfinished sessions
+EXIT_PENDING = 4
+
+COMMANDS = ['plan', 'fetch', 'build', 'status', 'gc', 'uninstall', 'verify']
+
+# Options replaced by commands, still accepted in place of them
+LEGACY_OPTIONS = {
+    '--plan': 'plan',
+    '--fetch-only': 'fetch',
+    '--gc': 'gc',
+    '--uninstall': 'uninstall',
+    '--verify': 'verify'
+}
 
-    print('\nInstallation directories')
-    for d in INSTALLDIRS:
-        value = getattr(build_conf, d)
-        print('  %-24s %s' % (d, value if value else 'default'))
+def print_json(value):
+    import json
+    json.dump(value, sys.stdout, indent=2)
+    print()
+
+def print_plan(plan, as_json):
+    if as_json:
+        print_json(plan.to_json())
+        return
+    levels = plan.levels()
+    print('\nBuild plan')
+    for name in plan.order:
+        pkg = plan.packages[name]
+        if name in plan.upgrades:
+            print('  %-4d %-24s %s (installed: %s)' %
+                  (levels[name], name, pkg.version, plan.upgrades[name]))
+        else:
+            print('  %-4d %-24s %s' % (levels[name], name, pkg.version))
+    for title, names in [('Already installed', plan.installed),
+                         ('Missing from registry', plan.missing),
+                         ('Cancelled', plan.cancelled)]:
+        if names:
+            print('\n' + title)
+            for name in names:
+                print('  ' + name)
+    path = plan.critical_path()[0]
+    print('\n  %-24s %s' % ('Critical path', ' -> '.join(path) or 'none'))
+    print('  %-24s %d' % ('Maximum width', plan.width()))
+
+def hit_rate(hits, misses):
+    if hits + misses == 0:
+        return '-'
+    return '%d/%d (%d%%)' % (hits, hits + misses,
+                             hits * 100 // (hits + misses))
+
+def print_compiler_cache(report):
+    import compcache
+    if compcache.tool is None:
+        return
+    totals = compcache.totals()
+    if totals is not None:
+        print('\nCompiler cache hits')
+        print('  %-24s %s' % ('All packages', hit_rate(*totals)))
+        return
+    if not compcache.stats:
+        return
+    print('\nCompiler cache hits')
+    for name in sorted(compcache.stats):
+        hits, misses = compcache.stats[name]
+        print('  %-24s %s' % (name, hit_rate(hits, misses)))
+        report.annotate(name, 'compiler_cache', {'hits': hits,
+                                                 'misses': misses})
 
-    print('\nTarget triplets')
-    for d in ['build', 'host', 'target']:
-        value = getattr(build_conf, d)
-        print('  %-24s %s' % (d, value if value else 'default'))
+def print_report(build_conf, report, plan=None):
+    import fetcher
+    import metrics
+    print('  %-24s %s' % ('Downloaded',
+                          fetcher.format_size(report.downloaded)))
+    print('  %-24s %s' % ('Elapsed', metrics.format_time(report.elapsed())))
+    slowest = report.slowest(build_conf.slowest_phases)
+    if slowest:
+        print('\nSlowest phases')
+        for name, record in slowest:
+            print('  %-24s %-10s %s' % (name, record['phase'],
+                                        metrics.format_time(record['wall'])))
+    print_compiler_cache(report)
+    if plan is not None:
+        path, total = report.critical_path(plan)
+        if path:
+            print('\nCritical path (%s)' % metrics.format_time(total))
+            print('  ' + ' -> '.join(path))
+    if build_conf.report != 'none':
+        report.write(build_conf.report, plan)
+        print('\nReport written to build/' + build_conf.report)
+
+# Configurations of every variant declared in build.conf, or the build
+# configuration itself if it has none
+def variant_configs(build_conf):
+    if not build_conf.variants:
+        return [build_conf]
+    import manifest
+    confs = [config.BuildConfig(v) for v in build_conf.variants]
+    # Variants installing into the same place would replace each other's
+    # packages without either being told
+    paths = {}
+    for conf in confs:
+        path = manifest.db_path(conf)
+        if path in paths:
+            console.error('variants `%s\' and `%s\' share the manifest `%s\', '
+                          'give them different installation directories' %
+                          (paths[path], conf.variant, path))
+        paths[path] = conf.variant
+    return confs
+
+# Manifests of the installation directories of every variant, as pairs of
+# the variant and its manifest
+def variant_manifests(build_conf):
+    import manifest
+    return [(conf.variant, manifest.setup(conf))
+            for conf in variant_configs(build_conf)]
+
+# Installations of a package given as NAME, or as NAME:VARIANT to only look
+# in one variant, as (variant, manifest, name) tuples
+def find_installed(manifests, arg):
+    name, sep, variant = arg.partition(':')
+    return [(v, db, name) for v, db in manifests
+            if (not sep or v == variant) and db.lookup(name) is not None]
+
+def package_id(name, variant):
+    return '%s:%s' % (name, variant) if variant else name
+
+# Resolve the packages to build in every variant
+def resolve_all(build_conf, confs):
+    import manifest
+    import registry
+    import resolver
+    for conf in confs:
+        manifest.setup(conf)
+    plan = resolver.resolve_variants(build_conf.packages, confs)
+    registry.save()
+    return plan
+
+def print_settings(build_conf, confs):
+    import pkgbuilder
+    for conf in confs:
+        suffix = ' (%s)' % conf.variant if conf.variant else ''
+        print('\nInstallation directories' + suffix)
+        for d in pkgbuilder.INSTALLDIRS:
+            value = getattr(conf, d)
+            print('  %-24s %s' % (d, value if value else 'default'))
+
+        print('\nTarget triplets' + suffix)
+        for d in ['build', 'host', 'target']:
+            value = getattr(conf, d)
+            print('  %-24s %s' % (d, value if value else 'default'))
+        for d in ['configure_args', 'meson_args']:
+            value = getattr(conf, 'variant_' + d)
+            if value:
+                print('  %-24s %s' % (d, value))
 
     print('\nPackages to install')
     for d in build_conf.packages:
         print('  ' + d)
 
-    pkgbuilder.setup_buildenv()
-    builddir = os.getcwd()
-    for d in build_conf.packages:
-        pkg = pkgbuilder.get_pkg(d, build_conf, warn_installed=False)
-        if pkg is not None:
-            pkg.add_confirm_notes()
-    print('\n'.join(pkgbuilder.confirm_notes))
-    response = input('\nProceed with installation? [Y/n] ')
+# Show what is about to be installed and ask for confirmation, unless it was
+# already given on the command line
+def confirm(plan, new_session, assume_yes):
+    import journal
+    import textwrap
+    if plan.upgrades:
+        print('\nPackages to upgrade or rebuild')
+        for name in plan.order:
+            if name in plan.upgrades:
+                print('  %-24s %s -> %s' % (name, plan.upgrades[name],
+                                            plan.packages[name].version))
+    noted = set()
+    for pkg in plan.pkgs():
+        if pkg.confirm_notes is not None and pkg.name not in noted:
+            noted.add(pkg.name)
+            print('\n%s-%s:' % (pkg.name, pkg.version))
+            for l in textwrap.wrap(pkg.confirm_notes, 74,
+                                   break_long_words=False):
+                print('  ' + l)
+    if new_session and journal.interrupted():
+        print('\nThe last build session did not finish, it can be continued '
+              'with --resume.')
+    if assume_yes:
+        return True
+    try:
+        response = input('\nProceed with installation? [Y/n] ')
+    except EOFError:
+        print('\nInstallation cancelled, use --yes to install without '
+              'confirmation.')
+        return False
     if len(response) > 0 and response[0].lower() == 'n':
         print('Installation cancelled.')
-        return
+        return False
+    return True
+
+# Build or download the packages, returning the exit status and a summary
+def build_all(build_conf, fetch_only=False, verbose=False, resume=False,
+              retry_failed=False, assume_yes=False):
+    import cache
+    import compcache
+    import confcache
+    import extract
+    import jobserver
+    import journal
+    import logs
+    import metrics
+    import pkgbuilder
+    import prefetch
+    import scheduler
+    import workspace
+
+    confs = variant_configs(build_conf)
+    print_settings(build_conf, confs)
+    pkgbuilder.setup_buildenv()
+    jobserver.setup(build_conf)
+    cache.setup(build_conf)
+    extract.backend = build_conf.extractor
+    logs.setup(build_conf, verbose)
+    compcache.setup(build_conf)
+    confcache.setup(build_conf)
+    workspace.setup(build_conf)
+    plan = resolve_all(build_conf, confs)
+    if not confirm(plan, not resume and not fetch_only, assume_yes):
+        return EXIT_CANCELLED, {}
     print()
-    for d in build_conf.packages:
-        pkg = pkgbuilder.get_pkg(d, build_conf)
-        if pkg is None:
-            console.warn('skipping package `%s\'' % d)
-            pkgbuilder.failures += 1
-            os.chdir(builddir)
-        elif d not in pkgbuilder.built:
-            try:
-                pkg.run()
-            except (ValueError, subprocess.CalledProcessError):
-                pkgbuilder.failures += 1
-                console.warn('package `%s\' failed to build' % d)
-            else:
-                pkgbuilder.successes += 1
-                pkgbuilder.built.append(d)
+    report = metrics.setup()
+    if not fetch_only:
+        journal.setup(build_conf, resume)
+    sched = scheduler.Scheduler(build_conf, plan)
+    if resume and not fetch_only:
+        sched.resume(retry_failed)
+    # Packages in the artifact cache do not need their archive
+    downloads = prefetch.start(build_conf, [p for p in sched.packages()
+                                            if not p.cached()])
+    if fetch_only:
+        succeeded, failed = downloads.wait_all()
+        print('\nFinished downloads.')
+        print('  %-24s %d' % ('Succeeded', succeeded))
+        print('  %-24s %d' % ('Failed', failed))
+        print_report(build_conf, report)
+        summary = {
+            'succeeded': succeeded,
+            'failed': failed
+        }
+        return EXIT_FAILED if failed else EXIT_OK, summary
+    sched.run()
+    downloads.shutdown()
+    journal.journal.finish()
     print('\nFinished jobs.')
     print('  %-24s %d' % ('Succeeded', pkgbuilder.successes))
     print('  %-24s %d' % ('Skipped', pkgbuilder.skips))
     print('  %-24s %d' % ('Failed', pkgbuilder.failures))
+    if sched.test_failures:
+        print('\nTest failures')
+        for name in sched.test_failures:
+            print('  ' + name)
+    print_report(build_conf, report, plan)
+    summary = {
+        'succeeded': pkgbuilder.successes,
+        'skipped': pkgbuilder.skips,
+        'failed': pkgbuilder.failures,
+        'test_failures': sched.test_failures,
+        'packages': {name: entry['result']
+                     for name, entry in report.packages.items()}
+    }
+    if pkgbuilder.failures or sched.test_failures:
+        return EXIT_FAILED, summary
+    return EXIT_OK, summary
+
+# With JSON output, everything printed while building goes to standard error
+# so that standard output only holds the summary written at the end
+def run_build(build_conf, args, fetch_only=False):
+    import contextlib
+    with contextlib.ExitStack() as stack:
+        if args.json:
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        status, summary = build_all(build_conf, fetch_only, args.verbose,
+                                    args.resume or args.retry_failed,
+                                    args.retry_failed, args.yes)
+    if args.json:
+        summary['status'] = status
+        print_json(summary)
+    return status
+
+def show_plan(build_conf, as_json=False, check=False):
+    import pkgbuilder
+    confs = variant_configs(build_conf)
+    pkgbuilder.setup_buildenv()
+    plan = resolve_all(build_conf, confs)
+    print_plan(plan, as_json)
+    if plan.missing or plan.cancelled:
+        return EXIT_FAILED
+    if check and plan.order:
+        return EXIT_PENDING
+    return EXIT_OK
+
+def format_timestamp(t):
+    import time
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+# Show the state of the last build session and the installed packages,
+# without reading the package registry
+def show_status(build_conf, as_json=False):
+    import journal
+    import manifest
+    last = journal.load(os.path.join('build', journal.PATH))
+    installed = {}
+    for conf in variant_configs(build_conf):
+        installed[conf.variant] = manifest.setup(conf).packages()
+    if last is None:
+        status = EXIT_OK
+    elif not last.data.get('finished'):
+        status = EXIT_PENDING
+    elif any(entry['state'] in ['failed', 'cancelled']
+             for entry in last.data['packages'].values()):
+        status = EXIT_FAILED
+    else:
+        status = EXIT_OK
+    if as_json:
+        print_json({
+            'status': status,
+            'session': last.data if last is not None else None,
+            'installed': {variant: [{'name': name, 'version': version}
+                                    for name, version in pkgs]
+                          for variant, pkgs in installed.items()}
+        })
+        return status
+    if last is None:
+        print('No build session')
+    else:
+        print('Last build session')
+        print('  %-24s %s' % ('Started',
+                              format_timestamp(last.data['started'])))
+        print('  %-24s %s' % ('Updated',
+                              format_timestamp(last.data['updated'])))
+        print('  %-24s %s' % ('Finished',
+                              'yes' if last.data.get('finished') else 'no'))
+        for state, count in sorted(last.counts().items()):
+            print('  %-24s %d' % (state.capitalize(), count))
+        failed = sorted(name for name, entry in last.data['packages'].items()
+                        if entry['state'] == 'failed')
+        if failed:
+            print('\nFailed packages')
+            for name in failed:
+                print('  ' + name)
+    for variant, pkgs in installed.items():
+        print('\nInstalled packages' + (' (%s)' % variant if variant else ''))
+        for name, version in pkgs:
+            print('  %-24s %s' % (name, version))
+        if not pkgs:
+            print('  none')
+    return status
+
+def collect_garbage(build_conf):
+    import cache
+    import fetcher
+    cache.setup(build_conf)
+    if cache.sources is not None:
+        removed, freed = cache.sources.gc()
+        print('Removed %d cached archives, freed %s' %
+              (removed, fetcher.format_size(freed)))
+    if cache.artifacts is not None:
+        removed, freed = cache.artifacts.gc()
+        print('Removed %d cached builds, freed %s' %
+              (removed, fetcher.format_size(freed)))
+    if build_conf.workspace_size and os.path.isdir('build'):
+        import pkgbuilder
+        import workspace
+        pkgbuilder.setup_buildenv()
+        workspace.setup(build_conf)
+        workspace.cleanup()
+    return EXIT_OK
+
+def uninstall(build_conf, names):
+    manifests = variant_manifests(build_conf)
+    selected = []
+    for arg in names:
+        found = find_installed(manifests, arg)
+        if not found:
+            console.error('package `%s\' is not installed' % arg)
+        selected += found
+    for variant, db, name in selected:
+        dependents = [d for d in db.dependents(name)
+                      if not any(v == variant and n == d
+                                 for v, _, n in selected)]
+        if dependents:
+            console.error('package `%s\' is needed by %s' %
+                          (package_id(name, variant), ', '.join(dependents)))
+    for variant, db, name in selected:
+        removed = db.uninstall(name)
+        print('Uninstalled %s, removed %d files' %
+              (package_id(name, variant), removed))
+    return EXIT_OK
+
+def verify(build_conf, names):
+    manifests = variant_manifests(build_conf)
+    selected = []
+    problems = 0
+    if not names:
+        for variant, db in manifests:
+            selected += [(variant, db, name) for name, version in db.packages()]
+    for arg in names:
+        found = find_installed(manifests, arg)
+        if not found:
+            console.warn('package `%s\' is not installed' % arg)
+            problems += 1
+        selected += found
+    for variant, db, name in selected:
+        for path, problem in db.verify(name):
+            print('%s: %s %s' % (package_id(name, variant), problem, path))
+            problems += 1
+    if problems:
+        return EXIT_FAILED
+    print('Verified %d packages.' % len(selected))
+    return EXIT_OK
+
+# Parse a `[SECTION.]OPTION=VALUE' setting overriding build.conf
+def parse_define(value):
+    key, sep, value = value.partition('=')
+    if not sep or not key:
+        raise argparse.ArgumentTypeError('expected [SECTION.]OPTION=VALUE')
+    section, dot, key = key.rpartition('.')
+    return section, key, value
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Build and install packages '
+                                     'listed in build.conf.', epilog=
+                                     'Without a command, packages are built. '
+                                     'The exit status is 0 on success, 1 if '
+                                     'packages failed, 2 on usage errors, 3 '
+                                     'if the installation was cancelled and '
+                                     '4 if packages remain to be built.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-D', '--define', action='append', default=[],
+                        type=parse_define, metavar='[SECTION.]OPTION=VALUE',
+                        help='override an option of build.conf, such as '
+                        '`-D jobs=8\' or `-D InstallDirs.prefix=/opt\'')
+    common.add_argument('--json', action='store_true',
+                        help='write machine-readable output')
+    packages = argparse.ArgumentParser(add_help=False)
+    packages.add_argument('packages', nargs='*', metavar='PACKAGE',
+                          help='packages to build instead of the ones listed '
+                          'in build.conf')
+    run = argparse.ArgumentParser(add_help=False)
+    run.add_argument('-y', '--yes', '--non-interactive', action='store_true',
+                     help='do not ask for confirmation before installing')
+    run.add_argument('-v', '--verbose', action='store_true',
+                     help='show the output of every command instead of '
+                     'writing it to the log of each package')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    sub = subparsers.add_parser('plan', parents=[common, packages],
+                                help='show the build plan without building '
+                                'anything')
+    sub.add_argument('--check', action='store_true',
+                     help='exit with status 4 if any package needs to be '
+                     'built')
+    sub = subparsers.add_parser('fetch', parents=[common, packages, run],
+                                help='only download the archives of the '
+                                'packages that would be built')
+    sub.set_defaults(resume=False, retry_failed=False)
+    sub = subparsers.add_parser('build', parents=[common, packages, run],
+                                help='build and install packages')
+    sub.add_argument('--resume', action='store_true',
+                     help='continue the last build session, skipping the '
+                     'packages it completed and the ones that failed')
+    sub.add_argument('--retry-failed', action='store_true',
+                     help='continue the last build session, building the '
+                     'packages that failed again')
+    sub.add_argument('--keep-going', action='store_true', default=None,
+                     help='keep building packages that do not depend on a '
+                     'package that failed')
+    sub.add_argument('--no-keep-going', action='store_false',
+                     dest='keep_going',
+                     help='stop starting packages once one fails')
+    subparsers.add_parser('status', parents=[common],
+                          help='show the state of the last build session and '
+                          'the installed packages')
+    subparsers.add_parser('gc', parents=[common],
+                          help='remove old entries from the source and '
+                          'artifact caches and clean up old build trees '
+                          'until they fit in their size limits')
+    sub = subparsers.add_parser('uninstall', parents=[common],
+                                help='remove the files installed by packages, '
+                                'in every variant unless given as '
+                                'PACKAGE:VARIANT')
+    sub.add_argument('packages', nargs='+', metavar='PACKAGE')
+    sub = subparsers.add_parser('verify', parents=[common],
+                                help='check that the files installed by '
+                                'packages, or by every package if none are '
+                                'given, are unchanged')
+    sub.add_argument('packages', nargs='*', metavar='PACKAGE')
+    return parser
+
+# Options taking a value, which can be given as a separate argument
+VALUE_OPTIONS = ['-D', '--define']
+
+# Index of the first argument before any `--' that is not an option or the
+# value of one, or None if there is none
+def first_positional(argv):
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--':
+            return None
+        if not arg.startswith('-') or arg == '-':
+            return i
+        i += 2 if arg in VALUE_OPTIONS else 1
+    return None
+
+# Turn the options used before there were commands into commands, move the
+# command before any options given ahead of it, and build packages when no
+# command is given
+def normalize_args(argv):
+    for i, arg in enumerate(argv):
+        if arg == '--':
+            break
+        if arg in LEGACY_OPTIONS:
+            return [LEGACY_OPTIONS[arg]] + argv[:i] + argv[i + 1:]
+    if argv and argv[0] in ['-h', '--help']:
+        return argv
+    i = first_positional(argv)
+    if i is not None and argv[i] in COMMANDS:
+        return [argv[i]] + argv[:i] + argv[i + 1:]
+    return ['build'] + argv
+
+def main(argv):
+    args = make_parser().parse_args(normalize_args(argv))
+    config.overrides = args.define
+    if args.command in ['plan', 'fetch', 'build'] and args.packages:
+        config.overrides.append(('Packages', 'packages',
+                                 ' '.join(args.packages)))
+    build_conf = config.BuildConfig()
+    if getattr(args, 'keep_going', None) is not None:
+        build_conf.keep_going = args.keep_going
+    if args.command == 'plan':
+        return show_plan(build_conf, args.json, args.check)
+    elif args.command == 'fetch':
+        return run_build(build_conf, args, fetch_only=True)
+    elif args.command == 'status':
+        return show_status(build_conf, args.json)
+    elif args.command == 'gc':
+        return collect_garbage(build_conf)
+    elif args.command == 'uninstall':
+        return uninstall(build_conf, args.packages)
+    elif args.command == 'verify':
+        return verify(build_conf, args.packages)
+    return run_build(build_conf, args)
 
 if __name__ == '__main__':
     if sys.version_info[1] < 5:
         console.error('this script requires at least Python 3.5')
-    build_all()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,162 @@
+# cache.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import console
+import contextlib
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+
+# Temporary files older than this are assumed to be abandoned
+STALE_TMP_AGE = 24 * 60 * 60
+
+sources = None
+artifacts = None
+
+def link_or_copy(src, dest):
+    try:
+        os.unlink(dest)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+# A directory of files named by a hash of their contents, which may be shared
+# by several gnukit processes at once. Entries are replaced atomically, and
+# the least recently used entries are removed once the cache grows past its
+# size limit.
+class Cache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            console.error('failed to create cache directory `%s\': %s' %
+                          (directory, os.strerror(e.errno)))
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    # Link or copy a cached entry to `dest', returning whether it was found.
+    # If given, `check' is called with `dest' to verify the entry, and an
+    # entry it rejects is removed from the cache as if it was never there.
+    def fetch(self, key, dest, check=None):
+        path = self.path(key)
+        with self.lock():
+            if not os.path.isfile(path):
+                return False
+            # The modification time records when the entry was last used
+            os.utime(path)
+            link_or_copy(path, dest)
+        if check is not None and not check(dest):
+            console.warn('removing corrupt cache entry `%s\'' % path)
+            os.unlink(dest)
+            self.remove(key)
+            return False
+        return True
+
+    def remove(self, key):
+        with self.lock(exclusive=True):
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def store(self, src, key):
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        os.close(fd)
+        try:
+            link_or_copy(src, tmp)
+            with self.lock(exclusive=True):
+                os.replace(tmp, self.path(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self.evict()
+
+    def entries(self):
+        ret = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            ret.append((st.st_mtime, st.st_size, path))
+        return ret
+
+    # Remove the least recently used entries until the cache fits in its
+    # size limit. Returns the number of entries removed and bytes freed.
+    def evict(self):
+        removed = 0
+        freed = 0
+        with self.lock(exclusive=True):
+            entries = sorted(self.entries())
+            total = sum(e[1] for e in entries)
+            for mtime, size, path in entries:
+                if not self.max_size or total <= self.max_size:
+                    break
+                os.unlink(path)
+                total -= size
+                removed += 1
+                freed += size
+        return removed, freed
+
+    # Evict old entries and clean up temporary files left behind by
+    # interrupted processes
+    def gc(self):
+        removed, freed = self.evict()
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith('.tmp-'):
+                continue
+            st = os.stat(path)
+            if now - st.st_mtime > STALE_TMP_AGE:
+                os.unlink(path)
+                freed += st.st_size
+        return removed, freed
+
+def default_dir(name):
+    base = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'gnukit', name)
+
+def setup(build_conf):
+    global sources
+    global artifacts
+    if build_conf.source_cache != 'none':
+        directory = build_conf.source_cache or default_dir('sources')
+        sources = Cache(os.path.expanduser(directory),
+                        build_conf.source_cache_size)
+    if build_conf.artifact_cache:
+        artifacts = Cache(os.path.expanduser(build_conf.artifact_cache),
+                          build_conf.artifact_cache_size)
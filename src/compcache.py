@@ -0,0 +1,181 @@
+# compcache.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import cache
+import console
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+
+TOOLS = ['ccache', 'sccache']
+
+# Compiler variables wrapped with the compiler cache when they are set
+COMPILERS = ['CC', 'CXX']
+
+# Compilers run through ccache when they are found in its masquerade
+# directory, which comes first in the search path of packages that do not
+# set the compiler. Other compilers, such as the `${host}-gcc' a cross build
+# looks for, are found in the search path as usual.
+MASQUERADE = ['cc', 'c++', 'gcc', 'g++', 'clang', 'clang++']
+
+# Path to the compiler cache executable, or None if it is disabled
+tool = None
+kind = None
+directory = None
+max_size = 0
+masquerade = None
+
+# Cache hits and misses of each package, only known for ccache
+stats = {}
+stats_lock = threading.Lock()
+
+# The ccache statistics log of the package being built by each thread
+current = threading.local()
+
+def find_tool(name):
+    if name == 'auto':
+        for t in TOOLS:
+            path = shutil.which(t)
+            if path is not None:
+                return path
+        return None
+    return shutil.which(os.path.expanduser(name))
+
+# Prefix the compilers set in a process environment with the compiler cache,
+# such as `CC=clang', and otherwise let the ccache masquerade directory catch
+# the compilers found in the search path
+def wrap(env):
+    if tool is None:
+        return
+    for var in COMPILERS:
+        words = env.get(var, '').split()
+        if not words or os.path.basename(words[0]) in TOOLS:
+            continue
+        env[var] = '%s %s' % (tool, env[var])
+    if masquerade is not None:
+        env['PATH'] = masquerade + os.pathsep + env.get('PATH', os.defpath)
+    if kind == 'ccache':
+        env['CCACHE_DIR'] = directory
+        env['CCACHE_MAXSIZE'] = '%dKi' % (max_size // 1024)
+        statslog = getattr(current, 'statslog', None)
+        if statslog is not None:
+            env['CCACHE_STATSLOG'] = statslog
+    else:
+        env['SCCACHE_DIR'] = directory
+        env['SCCACHE_CACHE_SIZE'] = '%dK' % (max_size // 1024)
+
+# Count the cache hits and misses in a ccache statistics log, which has one
+# line naming the result of each compilation after a comment naming the file
+def read_statslog(path):
+    hits = 0
+    misses = 0
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line.endswith('_hit'):
+                    hits += 1
+                elif line == 'cache_miss':
+                    misses += 1
+    except FileNotFoundError:
+        return None
+    return hits, misses
+
+# Record the cache hits and misses of the compilations run for a package by
+# the current thread. ccache 4.0 or later is needed to log them.
+@contextlib.contextmanager
+def package(pkg):
+    if kind != 'ccache':
+        yield
+        return
+    statslog = os.path.join(pkg.statedir, 'ccache-stats.log')
+    os.makedirs(pkg.statedir, exist_ok=True)
+    if os.path.isfile(statslog):
+        os.unlink(statslog)
+    current.statslog = statslog
+    try:
+        yield
+    finally:
+        current.statslog = None
+        result = read_statslog(statslog)
+        if result is not None and sum(result):
+            with stats_lock:
+                stats[pkg.id] = result
+
+# Name of the compiler cache in use, which affects how packages are
+# configured
+def name():
+    return kind or ''
+
+# Create a directory of links to ccache named after the compilers it should
+# run, which ccache recognizes to find the real compiler further in the
+# search path
+def setup_masquerade():
+    global masquerade
+    path = os.path.join(directory, 'masquerade')
+    os.makedirs(path, exist_ok=True)
+    for compiler in MASQUERADE:
+        link = os.path.join(path, compiler)
+        if os.path.islink(link) and os.readlink(link) == tool:
+            continue
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(tool, link)
+    masquerade = path
+
+# Cache hits and misses of all packages together, as reported by sccache,
+# which does not log them per compilation
+def totals():
+    if kind != 'sccache':
+        return None
+    env = dict(os.environ)
+    wrap(env)
+    try:
+        output = subprocess.check_output([tool, '--show-stats',
+                                          '--stats-format=json'], env=env,
+                                         stderr=subprocess.DEVNULL)
+        values = json.loads(output.decode())['stats']
+        hits = sum(values['cache_hits']['counts'].values())
+        misses = sum(values['cache_misses']['counts'].values())
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+        return None
+    return hits, misses
+
+def setup(build_conf):
+    global tool, kind, directory, max_size
+    if not build_conf.compiler_cache or build_conf.compiler_cache == 'none':
+        return
+    tool = find_tool(build_conf.compiler_cache)
+    if tool is None:
+        console.warn('compiler cache `%s\' not found, building without it' %
+                     build_conf.compiler_cache)
+        return
+    kind = 'sccache' if 'sccache' in os.path.basename(tool) else 'ccache'
+    directory = os.path.expanduser(build_conf.compiler_cache_dir or
+                                   cache.default_dir(kind))
+    os.makedirs(directory, exist_ok=True)
+    max_size = build_conf.compiler_cache_size
+    if kind == 'ccache':
+        setup_masquerade()
+    else:
+        # Only count the compilations of this run
+        env = dict(os.environ)
+        wrap(env)
+        subprocess.call([tool, '--zero-stats'], env=env,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -0,0 +1,150 @@
+# confcache.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import compcache
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+
+DIRECTORY = 'config-cache'
+
+# Variables that change the results of configure tests
+PRECIOUS = [
+    'CC',
+    'CFLAGS',
+    'CPP',
+    'CPPFLAGS',
+    'CXX',
+    'CXXCPP',
+    'CXXFLAGS',
+    'LDFLAGS',
+    'LIBS',
+    'PKG_CONFIG',
+    'PKG_CONFIG_LIBDIR',
+    'PKG_CONFIG_PATH'
+]
+
+# Compilers configure looks for when a compiler variable is not set
+DEFAULT_COMPILERS = {'CC': 'cc', 'CXX': 'c++'}
+
+ENTRY = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)=')
+
+enabled = False
+
+# Identify the compiler a compiler variable runs by its path, size and
+# modification time, so that upgrading it starts a new cache
+def compiler_id(command):
+    words = [w for w in command.split()
+             if os.path.basename(w) not in compcache.TOOLS]
+    if not words:
+        return ''
+    path = shutil.which(words[0])
+    if path is None:
+        return words[0]
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return '%s %d %d' % (path, st.st_size, st.st_mtime_ns)
+
+def cache_key(build_conf, env, pkg_env):
+    h = hashlib.sha256()
+    h.update(('%s\0' % ' '.join(os.uname())).encode())
+    for d in ['build', 'host', 'target']:
+        h.update(('%s=%s\0' % (d, getattr(build_conf, d))).encode())
+    # Arguments given to every package of a variant, such as CFLAGS
+    if build_conf.variant_configure_args:
+        h.update(('%s\0' % build_conf.variant_configure_args).encode())
+    for var in sorted(set(PRECIOUS) | set(pkg_env)):
+        h.update(('%s=%s\0' % (var, env.get(var, ''))).encode())
+    for var in compcache.COMPILERS:
+        compiler = env.get(var) or DEFAULT_COMPILERS[var]
+        h.update(('%s\0' % compiler_id(compiler)).encode())
+    return h.hexdigest()[:16]
+
+# Split an autoconf cache file into its header comments and its entries,
+# keeping the lines of multi-line values with their entry
+def parse(path):
+    header = []
+    entries = collections.OrderedDict()
+    name = None
+    try:
+        with open(path) as f:
+            for line in f:
+                m = ENTRY.match(line)
+                if m is not None:
+                    name = m.group(1)
+                    entries[name] = line
+                elif name is not None:
+                    entries[name] += line
+                else:
+                    header.append(line)
+    except FileNotFoundError:
+        pass
+    return header, entries
+
+# An autoconf cache file shared by the configure scripts of every package
+# built for the same triplets, toolchain and environment. Each configure run
+# works on a private copy, which is merged back once it succeeds so that
+# packages configured in parallel do not overwrite each other's results.
+class ConfigCache:
+    def __init__(self, key):
+        os.makedirs(DIRECTORY, exist_ok=True)
+        self.path = os.path.realpath(os.path.join(DIRECTORY, key + '.cache'))
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def copy_to(self, dest):
+        with self.lock():
+            if os.path.isfile(self.path):
+                shutil.copyfile(self.path, dest)
+            elif os.path.lexists(dest):
+                os.unlink(dest)
+
+    # Add the results of a configure run that are not in the shared cache
+    # yet. The values of precious variables are left out, as configure
+    # refuses to run when they differ from the ones in its cache.
+    def merge(self, src):
+        new_header, new = parse(src)
+        with self.lock(exclusive=True):
+            header, entries = parse(self.path)
+            added = False
+            for name, text in new.items():
+                if name in entries or name.startswith('ac_cv_env_'):
+                    continue
+                entries[name] = text
+                added = True
+            if not added:
+                return
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines(header or new_header)
+                for text in entries.values():
+                    f.write(text)
+            os.replace(tmp, self.path)
+
+def setup(build_conf):
+    global enabled
+    enabled = build_conf.configure_cache
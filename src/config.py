@@ -16,6 +16,26 @@
 
 import configparser
 import console
+import os
+import re
+
+SIZE_SUFFIXES = {
+    'K': 1 << 10,
+    'M': 1 << 20,
+    'G': 1 << 30,
+    'T': 1 << 40
+}
+
+# Parse a size such as `512M' or `2G' into a number of bytes
+def parse_size(value):
+    value = value.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    scale = 1
+    if value and value[-1] in SIZE_SUFFIXES:
+        scale = SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+    return int(float(value) * scale)
 
 def set_from(self, prop, attr, path):
     try:
@@ -25,12 +45,93 @@ def set_from(self, prop, attr, path):
     except KeyError:
         setattr(self, attr, '')
 
+def int_from(self, prop, attr, default):
+    try:
+        value = prop[attr]
+    except KeyError:
+        value = ''
+    if not value:
+        setattr(self, attr, default)
+        return
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        console.error('property `%s\' requires a positive integer' % attr)
+    setattr(self, attr, value)
+
+def size_from(self, prop, attr, default):
+    try:
+        value = prop[attr]
+    except KeyError:
+        value = ''
+    if not value:
+        setattr(self, attr, default)
+        return
+    try:
+        setattr(self, attr, parse_size(value))
+    except ValueError:
+        console.error('property `%s\' requires a size such as `512M\'' % attr)
+
+INSTALLDIRS_OPTIONS = ['prefix', 'eprefix', 'bindir', 'sbindir', 'libexecdir',
+                       'sysconfdir', 'sharedstatedir', 'localstatedir',
+                       'runstatedir', 'libdir', 'includedir', 'datadir',
+                       'infodir', 'localedir', 'mandir', 'docdir']
+
+TARGETS_OPTIONS = ['build', 'host', 'target']
+
+PACKAGES_OPTIONS = ['packages', 'tests', 'ignore_installed']
+
+# Options set on the command line, as (section, option, value) tuples. Options
+# given without a section go in the section they belong to.
+overrides = []
+
+# Prefix of the sections declaring build variants
+VARIANT_SECTION = 'Variant '
+
+# Override the installation directories and target triplets of the
+# configuration with the ones of a variant, before they are interpolated so
+# that directories such as `${prefix}/bin' follow the prefix of the variant
+def apply_variant(self, config, variant):
+    section = VARIANT_SECTION + variant
+    if not re.match(r'^[A-Za-z0-9_.+-]+$', variant):
+        console.error('invalid variant name `%s\'' % variant)
+    if not config.has_section(section):
+        console.error('no variant `%s\' in configuration file' % variant)
+    for key in config[section]:
+        if key in INSTALLDIRS_OPTIONS:
+            config.set('InstallDirs', key, config.get(section, key, raw=True))
+        elif key in TARGETS_OPTIONS:
+            config.set('Targets', key, config.get(section, key, raw=True))
+        elif key not in ['configure_args', 'meson_args']:
+            console.error('invalid option `%s\' for variant `%s\'' %
+                          (key, variant))
+    self.variant_configure_args = config[section].get('configure_args', '')
+    self.variant_meson_args = config[section].get('meson_args', '')
+
+def apply_overrides(config):
+    for section, key, value in overrides:
+        if not section:
+            if key in INSTALLDIRS_OPTIONS:
+                section = 'InstallDirs'
+            elif key in TARGETS_OPTIONS:
+                section = 'Targets'
+            elif key in PACKAGES_OPTIONS:
+                section = 'Packages'
+            else:
+                section = 'Build'
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, value)
+
 class BuildConfig:
-    def __init__(self):
+    def __init__(self, variant=None):
         config = configparser.ConfigParser(interpolation=
                                            configparser.ExtendedInterpolation())
         if not config.read('build.conf'):
             console.error('couldn\'t read configuration file `build.conf\'')
+        apply_overrides(config)
         try:
             install_dirs = config['InstallDirs']
         except AttributeError:
@@ -43,6 +144,19 @@ class BuildConfig:
             packages = config['Packages']
         except AttributeError:
             console.error('config file missing required section `Packages\'')
+        if config.has_section('Build'):
+            build = config['Build']
+        else:
+            build = {}
+
+        # Set the variant being built, if any
+        self.variants = [s[len(VARIANT_SECTION):] for s in config.sections()
+                         if s.startswith(VARIANT_SECTION)]
+        self.variant = variant or ''
+        self.variant_configure_args = ''
+        self.variant_meson_args = ''
+        if variant:
+            apply_variant(self, config, variant)
 
         # Set configuration file data
         set_from(self, install_dirs, 'prefix', True)
@@ -81,3 +195,86 @@ class BuildConfig:
             self.ignore_installed = packages['ignore_installed'] == 'true'
         except KeyError:
             self.ignore_installed = False
+
+        # Set build scheduling options
+        int_from(self, build, 'max_parallel_packages', 1)
+        int_from(self, build, 'jobs', os.cpu_count() or 1)
+        size_from(self, build, 'memory', 0)
+        int_from(self, build, 'max_parallel_downloads', 4)
+        int_from(self, build, 'max_host_connections', 2)
+        try:
+            self.source_cache = build['source_cache']
+        except KeyError:
+            self.source_cache = ''
+        size_from(self, build, 'source_cache_size', parse_size('20G'))
+        try:
+            self.artifact_cache = build['artifact_cache']
+        except KeyError:
+            self.artifact_cache = ''
+        size_from(self, build, 'artifact_cache_size', parse_size('50G'))
+        try:
+            self.extractor = build['extractor'] or 'auto'
+        except KeyError:
+            self.extractor = 'auto'
+        if self.extractor not in ['auto', 'tarfile']:
+            console.error('invalid extractor `%s\'' % self.extractor)
+        try:
+            self.report = build['report'] or 'report.json'
+        except KeyError:
+            self.report = 'report.json'
+        int_from(self, build, 'slowest_phases', 5)
+        try:
+            self.compress_logs = build['compress_logs'] == 'true'
+        except KeyError:
+            self.compress_logs = False
+        int_from(self, build, 'log_tail', 40)
+        try:
+            self.scratch_dir = build['scratch_dir']
+        except KeyError:
+            self.scratch_dir = ''
+        size_from(self, build, 'scratch_size', 0)
+        size_from(self, build, 'workspace_size', 0)
+        try:
+            self.workspace_cleanup = build['workspace_cleanup'] or 'remove'
+        except KeyError:
+            self.workspace_cleanup = 'remove'
+        if self.workspace_cleanup not in ['remove', 'compress']:
+            console.error('invalid workspace cleanup method `%s\'' %
+                          self.workspace_cleanup)
+        try:
+            self.configure_cache = build['configure_cache'] == 'true'
+        except KeyError:
+            self.configure_cache = False
+        try:
+            self.keep_going = build['keep_going'] != 'false'
+        except KeyError:
+            self.keep_going = True
+        try:
+            self.file_conflicts = build['file_conflicts'] or 'error'
+        except KeyError:
+            self.file_conflicts = 'error'
+        if self.file_conflicts not in ['error', 'overwrite']:
+            console.error('invalid file conflict handling `%s\'' %
+                          self.file_conflicts)
+        try:
+            self.background_tests = build['background_tests'] == 'true'
+        except KeyError:
+            self.background_tests = False
+        try:
+            self.abort_on_test_failure = \
+                build['abort_on_test_failure'] == 'true'
+        except KeyError:
+            self.abort_on_test_failure = False
+        try:
+            self.compiler_cache = build['compiler_cache']
+        except KeyError:
+            self.compiler_cache = ''
+        try:
+            self.compiler_cache_dir = build['compiler_cache_dir']
+        except KeyError:
+            self.compiler_cache_dir = ''
+        size_from(self, build, 'compiler_cache_size', parse_size('10G'))
+        try:
+            self.jobserver = build['jobserver'] or 'pipe'
+        except KeyError:
+            self.jobserver = 'pipe'
@@ -0,0 +1,136 @@
+# extract.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess
+import tarfile
+
+MAGIC = [
+    (b'\x1f\x8b', 'gz'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zst')
+]
+
+# Native decompressors for each format, in order of preference. Parallel
+# decompressors come first.
+DECOMPRESSORS = {
+    'gz': [['pigz', '-dc'], ['gzip', '-dc']],
+    'xz': [['xz', '-T0', '-dc']],
+    'bz2': [['pbzip2', '-dc'], ['lbzip2', '-dc'], ['bzip2', '-dc']],
+    'zst': [['zstd', '-T0', '-dc']],
+    'tar': [['cat']]
+}
+
+# Either `auto' to use native tools when available, or `tarfile' to always
+# use the tarfile module
+backend = 'auto'
+
+def detect_format(head):
+    for magic, fmt in MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return 'tar'
+
+def decompressors(fmt):
+    return [cmd for cmd in DECOMPRESSORS[fmt] if shutil.which(cmd[0])]
+
+# Return the decompressor command to pipe a format through, or None if the
+# tarfile module has to be used instead
+def native_command(fmt):
+    if backend != 'auto' or shutil.which('tar') is None:
+        return None
+    cmds = decompressors(fmt)
+    return cmds[0] if cmds else None
+
+# Start a decompressor piped into tar extracting into `dest'
+def spawn(cmd, dest, stdin):
+    decomp = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE)
+    tar = subprocess.Popen(['tar', '-xf', '-', '-C', dest],
+                           stdin=decomp.stdout)
+    decomp.stdout.close()
+    return [decomp, tar]
+
+def extract_archive(path, dest, cmd=None):
+    if cmd is None:
+        with open(path, 'rb') as f:
+            cmd = native_command(detect_format(f.read(8)))
+    if cmd is None:
+        with tarfile.open(path) as f:
+            f.extractall(dest)
+        return
+    with open(path, 'rb') as f:
+        procs = spawn(cmd, dest, f)
+    for p in procs:
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+
+# Extracts an archive while it is being downloaded. The data is fed in
+# chunks as it arrives, and is only trusted once finish() succeeds and the
+# download has been verified by the caller.
+class StreamExtractor:
+    def __init__(self, dest):
+        self.dest = dest
+        self.procs = None
+        self.failed = False
+
+    def __start(self, head):
+        cmd = native_command(detect_format(head))
+        if cmd is None:
+            self.failed = True
+            return
+        os.makedirs(self.dest, exist_ok=True)
+        self.procs = spawn(cmd, self.dest, subprocess.PIPE)
+
+    def feed(self, chunk):
+        if self.failed:
+            return
+        if self.procs is None:
+            self.__start(chunk)
+            if self.failed:
+                return
+        try:
+            self.procs[0].stdin.write(chunk)
+        except OSError:
+            self.abort()
+
+    def finish(self):
+        if self.failed or self.procs is None:
+            self.abort()
+            return False
+        try:
+            self.procs[0].stdin.close()
+        except OSError:
+            pass
+        codes = [p.wait() for p in self.procs]
+        if any(codes):
+            self.abort()
+            return False
+        return True
+
+    def abort(self):
+        self.failed = True
+        if self.procs is not None:
+            for p in self.procs:
+                p.kill()
+                p.wait()
+            try:
+                self.procs[0].stdin.close()
+            except OSError:
+                pass
+            self.procs = None
+        shutil.rmtree(self.dest, ignore_errors=True)
@@ -0,0 +1,206 @@
+# fetcher.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import http.client
+import metrics
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CHUNK_SIZE = 1 << 16
+TIMEOUT = 60
+PROBE_TIMEOUT = 10
+RETRIES = 3
+
+host_connections = 2
+host_slots = {}
+host_lock = threading.Lock()
+
+class ChecksumError(ValueError):
+    def __init__(self, md5):
+        ValueError.__init__(self, md5)
+        self.md5 = md5
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f GiB' % size
+
+class Progress:
+    def __init__(self, total, offset):
+        self.total = total
+        self.offset = offset
+        self.done = offset
+        self.start = time.monotonic()
+        self.last = 0
+        self.tty = sys.stdout.isatty()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        if elapsed <= 0:
+            return 0
+        return (self.done - self.offset) / elapsed
+
+    def update(self, size):
+        self.done += size
+        now = time.monotonic()
+        if not self.tty or now - self.last < 0.5:
+            return
+        self.last = now
+        if self.total:
+            line = '  %s / %s (%d%%)' % (format_size(self.done),
+                                        format_size(self.total),
+                                        self.done * 100 // self.total)
+        else:
+            line = '  ' + format_size(self.done)
+        print('\r%s, %s/s\033[K' % (line, format_size(self.rate())), end='',
+              flush=True)
+
+    def finish(self):
+        if self.tty:
+            print('\r\033[K', end='')
+        print('  Downloaded %s in %.1fs (%s/s)' %
+              (format_size(self.done - self.offset),
+               time.monotonic() - self.start, format_size(self.rate())))
+
+# Limit the number of simultaneous downloads from a single server
+def host_slot(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with host_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(host_connections)
+        return host_slots[host]
+
+def probe(url):
+    start = time.monotonic()
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        with urllib.request.urlopen(request, timeout=PROBE_TIMEOUT):
+            pass
+    except (OSError, http.client.HTTPException):
+        return None
+    return time.monotonic() - start
+
+# Order mirrors by how quickly they answer a HEAD request, with mirrors that
+# did not answer at all moved to the end
+def rank_mirrors(urls):
+    urls = list(urls)
+    if len(urls) < 2:
+        return urls
+    times = {}
+    def run(url):
+        times[url] = probe(url)
+    threads = [threading.Thread(target=run, args=(url,)) for url in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(urls, key=lambda url: (times[url] is None,
+                                         times[url] or 0))
+
+def md5sum(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Stream a URL into `part', continuing from whatever is already there if the
+# server supports range requests. Returns the MD5 digest of the whole file.
+# The data is also passed to `sink' as it arrives, unless the transfer
+# resumes a partial download, in which case the sink is aborted.
+def transfer(url, part, sink=None):
+    digest = hashlib.md5()
+    offset = 0
+    if os.path.isfile(part):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                offset += len(chunk)
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+        print('  Resuming download at %s' % format_size(offset))
+        if sink is not None:
+            sink.abort()
+            sink = None
+    try:
+        response = urllib.request.urlopen(request, timeout=TIMEOUT)
+    except urllib.error.HTTPError as e:
+        # The partial file already holds everything the server has
+        if e.code == 416 and offset:
+            return digest.hexdigest()
+        raise
+    with response:
+        if offset and response.status != 206:
+            # Range not supported, start over
+            digest = hashlib.md5()
+            offset = 0
+        try:
+            total = int(response.headers['Content-Length']) + offset
+        except (TypeError, ValueError):
+            total = 0
+        progress = Progress(total, offset)
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                digest.update(chunk)
+                progress.update(len(chunk))
+                metrics.downloaded(len(chunk))
+                if sink is not None:
+                    sink.feed(chunk)
+        if total and progress.done < total:
+            raise ConnectionError('connection closed after %s of %s' %
+                                  (format_size(progress.done),
+                                   format_size(total)))
+        progress.finish()
+    return digest.hexdigest()
+
+# Download a URL to `dest', which is only created once the MD5 checksum of
+# the downloaded data matches. Interrupted transfers are resumed from the
+# `.part' file left behind, both within this call and across runs.
+def download(url, dest, md5, sink=None):
+    part = dest + '.part'
+    resumed = os.path.isfile(part)
+    attempt = 0
+    while True:
+        try:
+            with host_slot(url):
+                got = transfer(url, part, sink)
+        except (http.client.HTTPException, ConnectionError,
+                socket.timeout) as e:
+            attempt += 1
+            if attempt > RETRIES:
+                raise ConnectionError(str(e)) from e
+            print('  Download interrupted (%s), retrying' % e)
+            continue
+        if got == md5:
+            os.replace(part, dest)
+            return
+        os.unlink(part)
+        # A stale partial file may have been resumed, so retry once from
+        # the beginning before blaming the server
+        if not resumed:
+            raise ChecksumError(got)
+        resumed = False
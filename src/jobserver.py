@@ -0,0 +1,169 @@
+# jobserver.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import atexit
+import console
+import os
+import select
+import threading
+
+server = None
+
+class Reservation:
+    def __init__(self, server, tokens, limit, shared):
+        self.server = server
+        self.tokens = tokens
+        self.limit = limit
+        self.shared = shared
+
+    # Environment variables passed to every process run for the package.
+    # meson test does not use the jobserver, so it is only given the limit.
+    def env(self):
+        if self.shared:
+            makeflags = self.server.makeflags()
+        else:
+            makeflags = '-j%d' % self.limit
+        return {'MAKEFLAGS': makeflags, 'MESON_TESTTHREADS': str(self.limit)}
+
+    # File descriptors the process needs to inherit to reach the jobserver
+    def fds(self):
+        if self.shared:
+            return self.server.fds()
+        return ()
+
+    # Extra arguments for ninja, which only understands the FIFO protocol
+    def ninja_args(self):
+        if self.shared and self.server.style == 'fifo':
+            return []
+        return ['-j', str(self.limit)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server.release(self.tokens)
+
+# A GNU make jobserver. The pool holds one token per job slot, and gnukit
+# takes a token for every package it is building so that the implicit job
+# slot of each top-level make is accounted for too. With the jobserver off,
+# no tokens are taken and every package runs with its own job limit.
+class Jobserver:
+    def __init__(self, jobs, memory, style, path):
+        self.jobs = jobs
+        self.memory = memory
+        self.style = style
+        self.path = path
+        self.lock = threading.Lock()
+        if style == 'fifo':
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            os.mkfifo(path, 0o600)
+            self.rfd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            self.wfd = os.open(path, os.O_WRONLY)
+            atexit.register(os.unlink, path)
+        else:
+            self.rfd, self.wfd = os.pipe()
+            os.set_inheritable(self.rfd, True)
+            os.set_inheritable(self.wfd, True)
+        os.write(self.wfd, b'+' * jobs)
+
+    def makeflags(self):
+        if self.style == 'fifo':
+            return '-j%d --jobserver-auth=fifo:%s' % (self.jobs, self.path)
+        if self.style == 'pipe':
+            return '-j%d --jobserver-auth=%d,%d --jobserver-fds=%d,%d' % \
+                (self.jobs, self.rfd, self.wfd, self.rfd, self.wfd)
+        return '-j%d' % self.jobs
+
+    def fds(self):
+        if self.style == 'pipe':
+            return (self.rfd, self.wfd)
+        return ()
+
+    def __take(self):
+        # Make clients may switch the shared descriptor to non-blocking
+        # mode, so wait for it to become readable instead of relying on a
+        # blocking read
+        while True:
+            select.select([self.rfd], [], [])
+            try:
+                token = os.read(self.rfd, 1)
+            except BlockingIOError:
+                continue
+            if token:
+                return token
+
+    # Take a token if one is free, or return nothing
+    def __try_take(self):
+        if not select.select([self.rfd], [], [], 0)[0]:
+            return b''
+        try:
+            return os.read(self.rfd, 1)
+        except BlockingIOError:
+            return b''
+
+    # Reserve job slots for a package. Packages with a per-job memory hint
+    # are given a private job limit that fits in the memory budget, and the
+    # corresponding number of tokens are held for the whole build so the
+    # global limit is still respected. Packages built with ninja also get a
+    # private limit when ninja cannot use the jobserver, of as many tokens
+    # as are free when they start but at least one.
+    def reserve(self, job_memory=0, ninja=False):
+        limit = self.jobs
+        if job_memory and self.memory:
+            limit = max(1, min(self.jobs, self.memory // job_memory))
+        if self.style == 'off':
+            # Every package gets the limit to itself
+            return Reservation(self, b'', limit, False)
+        greedy = ninja and self.style == 'pipe' and limit == self.jobs
+        shared = limit == self.jobs and not greedy
+        # Only one package may collect several tokens at a time, otherwise
+        # two of them could each hold part of the pool and wait forever
+        with self.lock:
+            if shared:
+                tokens = self.__take()
+            elif greedy:
+                tokens = self.__take()
+                while len(tokens) < limit:
+                    token = self.__try_take()
+                    if not token:
+                        break
+                    tokens += token
+                limit = len(tokens)
+            else:
+                tokens = b''.join(self.__take() for i in range(limit))
+        return Reservation(self, tokens, limit, shared)
+
+    def release(self, tokens):
+        if tokens:
+            os.write(self.wfd, tokens)
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return 0
+
+def setup(build_conf):
+    global server
+    if build_conf.jobserver not in ['fifo', 'pipe', 'off']:
+        console.error('invalid jobserver style `%s\'' % build_conf.jobserver)
+    server = Jobserver(build_conf.jobs,
+                       build_conf.memory or physical_memory(),
+                       build_conf.jobserver,
+                       os.path.realpath('jobserver.fifo'))
@@ -0,0 +1,118 @@
+# journal.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import console
+import json
+import os
+import time
+
+PATH = 'journal.json'
+
+# States of packages that do not need to be built again when a session is
+# resumed
+COMPLETED = ['succeeded', 'installed']
+
+journal = None
+
+# The state of every package of a build session, kept in the build directory
+# across runs so that an interrupted or failed session can be resumed. Each
+# change is written out right away, so the journal survives the build being
+# interrupted.
+class Journal:
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+
+    def write(self):
+        self.data['updated'] = time.time()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp, self.path)
+
+    # State recorded for a package in this session, or None if it has none
+    # or it was recorded for a different build of the package
+    def state(self, name, pkg):
+        entry = self.data['packages'].get(name)
+        if entry is None or entry['build_key'] != pkg.build_key:
+            return None
+        return entry['state']
+
+    def record(self, name, state, pkg=None):
+        entry = self.data['packages'].setdefault(name, {
+            'version': None,
+            'build_key': None
+        })
+        if pkg is not None:
+            entry['version'] = pkg.version
+            entry['build_key'] = pkg.build_key
+        entry['state'] = state
+        entry['time'] = time.time()
+        self.write()
+
+    def finish(self):
+        self.data['finished'] = True
+        self.write()
+
+    # Number of packages in each state
+    def counts(self):
+        ret = {}
+        for entry in self.data['packages'].values():
+            ret[entry['state']] = ret.get(entry['state'], 0) + 1
+        return ret
+
+def load(path=PATH):
+    try:
+        with open(path) as f:
+            return Journal(path, json.load(f))
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        console.warn('ignoring corrupt build journal `%s\'' % path)
+        return None
+
+# Whether the last build session did not run to completion
+def interrupted():
+    last = load()
+    return last is not None and not last.data.get('finished')
+
+# Start a new build session, or continue the last one when resuming
+def setup(build_conf, resume=False):
+    global journal
+    requested = {
+        'requested': build_conf.packages,
+        'variants': build_conf.variants
+    }
+    last = load()
+    if resume:
+        if last is None:
+            console.error('no build session to resume')
+        if any(last.data.get(k) != v for k, v in requested.items()):
+            console.warn('the packages or variants to build changed since '
+                         'the session being resumed')
+        last.data.update(requested)
+        last.data['finished'] = False
+        journal = last
+    else:
+        data = {
+            'started': time.time(),
+            'finished': False,
+            'packages': {}
+        }
+        data.update(requested)
+        journal = Journal(PATH, data)
+    journal.write()
+    return journal
@@ -0,0 +1,151 @@
+# logs.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import gzip
+import os
+import select
+import sys
+import threading
+
+# When true, the output of every command is passed through to the terminal
+# instead of being written to the log of its package
+verbose = True
+compress = False
+tail_lines = 40
+
+# Seconds to keep copying output after a process exits, which only matters
+# if it left behind a daemon holding its output pipe
+READER_TIMEOUT = 5
+POLL_INTERVAL = 0.5
+
+# The log of the package being built by each thread
+current = threading.local()
+
+# Output of the commands run for one package. Everything is written to the
+# log file, and the last lines are also kept in memory so they can be shown
+# if the package fails.
+class PackageLog:
+    def __init__(self, path):
+        self.path = path
+        if compress:
+            self.file = gzip.open(path, 'wb')
+        else:
+            self.file = open(path, 'wb')
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.lock = threading.Lock()
+
+    def write(self, line):
+        with self.lock:
+            self.file.write(line)
+            self.tail.append(line)
+
+    def message(self, text):
+        self.write(('%s\n' % text).encode())
+
+    def reader(self, stream):
+        return Reader(self, stream)
+
+    def print_tail(self):
+        with self.lock:
+            self.file.flush()
+            lines = list(self.tail)
+        print('\nLast %d lines of %s:' % (len(lines), self.path),
+              file=sys.stderr)
+        for line in lines:
+            sys.stderr.write('  ' + line.decode(errors='replace'))
+        sys.stderr.flush()
+
+    def close(self):
+        self.file.close()
+
+# Copies the output of a process into a log from a background thread, until
+# every process holding the pipe has closed it or the reader is stopped
+class Reader:
+    def __init__(self, log, stream):
+        self.log = log
+        self.stream = stream
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        fd = self.stream.fileno()
+        partial = b''
+        with self.stream:
+            while not self.stopping.is_set():
+                if not select.select([fd], [], [], POLL_INTERVAL)[0]:
+                    continue
+                data = os.read(fd, 1 << 16)
+                if not data:
+                    break
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    self.log.write(line + b'\n')
+            if partial:
+                self.log.write(partial)
+
+    # Wait for the output of a process that has exited. A daemon it started
+    # may still hold the pipe, so the pipe is closed after a while instead
+    # of waiting for the daemon to exit too.
+    def finish(self):
+        self.thread.join(READER_TIMEOUT)
+        if self.thread.is_alive():
+            self.stopping.set()
+            self.thread.join()
+            self.log.message('(output of processes still running after the '
+                             'command exited is not logged)')
+
+def log():
+    return getattr(current, 'log', None)
+
+# Send the commands run for a package by the current thread to its log file,
+# printing the end of the log if building the package fails
+@contextlib.contextmanager
+def package(pkg):
+    if verbose:
+        yield
+        return
+    name = 'build.log.gz' if compress else 'build.log'
+    os.makedirs(pkg.statedir, exist_ok=True)
+    current.log = PackageLog(os.path.join(pkg.statedir, name))
+    try:
+        yield
+    except BaseException:
+        current.log.print_tail()
+        raise
+    finally:
+        current.log.close()
+        current.log = None
+
+# Announce a step of a build. Without verbose output this is the only line
+# printed for it, so it names the package.
+def status(text):
+    if log() is None:
+        print('\n' + text)
+    else:
+        log().message('\n' + text)
+        # One write, so lines from packages built in parallel stay whole
+        sys.stdout.write(text + '\n')
+        sys.stdout.flush()
+
+def setup(build_conf, verbose_output):
+    global verbose, compress, tail_lines
+    verbose = verbose_output
+    compress = build_conf.compress_logs
+    tail_lines = build_conf.log_tail
@@ -0,0 +1,254 @@
+# manifest.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import configparser
+import contextlib
+import fcntl
+import hashlib
+import os
+import registry
+import sqlite3
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    build_key TEXT,
+    dependencies TEXT NOT NULL,
+    installed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    package TEXT NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_package ON files (package);
+'''
+
+# Files that several packages are expected to install, such as the index of
+# info manuals
+SHARED = ['share/info/dir', 'lib/charset.alias']
+
+db = None
+# Manifests by path, as variants may install into different directories
+manifests = {}
+
+def file_hash(path):
+    if os.path.islink(path):
+        return 'link:' + os.readlink(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def is_shared(path):
+    return any(path.endswith('/' + s) for s in SHARED)
+
+# Delete files and any directories left empty, returning the number of files
+# that were there
+def remove_files(paths):
+    dirs = set()
+    removed = 0
+    for path in paths:
+        if os.path.lexists(path):
+            os.unlink(path)
+            removed += 1
+        dirs.add(os.path.dirname(path))
+    for d in sorted(dirs, key=len, reverse=True):
+        while d != '/':
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+    return removed
+
+# Installed files of a staged installation, with the path each is installed
+# to and its hash
+def staged_files(stagedir):
+    ret = []
+    for root, dirs, files in os.walk(stagedir):
+        for name in files + [d for d in dirs
+                             if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            dest = '/' + os.path.relpath(path, stagedir)
+            ret.append((dest, file_hash(path)))
+    return ret
+
+# What is installed into the installation directories, as recorded when each
+# package was installed from a staging directory
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def connect(self, write=False):
+        if write:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        elif not os.path.isfile(self.path):
+            yield None
+            return
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            if write:
+                conn.executescript(SCHEMA)
+            elif conn.execute('SELECT 1 FROM sqlite_master WHERE '
+                              'name = \'files\'').fetchone() is None:
+                # Another package is only creating the database
+                yield None
+                return
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # Serialize merging installations into place and recording them, also
+    # between separate runs
+    @contextlib.contextmanager
+    def lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Version, build key and dependencies of an installed package, or None
+    def lookup(self, name):
+        with self.connect() as conn:
+            if conn is None:
+                return None
+            try:
+                row = conn.execute('SELECT version, build_key, dependencies '
+                                   'FROM packages WHERE name = ?',
+                                   (name,)).fetchone()
+            except sqlite3.OperationalError:
+                return None
+        if row is None:
+            return None
+        return row[0], row[1], row[2].split()
+
+    def packages(self):
+        with self.connect() as conn:
+            if conn is None:
+                return []
+            return conn.execute('SELECT name, version FROM packages '
+                                'ORDER BY name').fetchall()
+
+    def files(self, name):
+        with self.connect() as conn:
+            if conn is None:
+                return []
+            return conn.execute('SELECT path, hash FROM files '
+                                'WHERE package = ? ORDER BY path',
+                                (name,)).fetchall()
+
+    # Installed packages that depend on a package
+    def dependents(self, name):
+        with self.connect() as conn:
+            if conn is None:
+                return []
+            rows = conn.execute('SELECT name, dependencies FROM packages '
+                                'ORDER BY name').fetchall()
+        return [n for n, deps in rows if name in deps.split()]
+
+    # Record a package as installed with the given files. Files installed
+    # by another package before are now owned by this one. Files of the
+    # version installed before that this one no longer installs are deleted,
+    # except for the shared ones other packages may need. When the files are
+    # not known, such as for a package that ignored DESTDIR, the files of
+    # the previous version are left as they were.
+    def record(self, pkg, files=None):
+        if files is None:
+            stale = []
+        else:
+            new = set(path for path, h in files)
+            stale = [path for path, h in self.files(pkg.name)
+                     if path not in new and not is_shared(path)]
+        with self.connect(write=True) as conn:
+            conn.execute('INSERT OR REPLACE INTO packages VALUES '
+                         '(?, ?, ?, ?, ?)',
+                         (pkg.name, pkg.version, pkg.build_key,
+                          ' '.join(pkg.dependencies), time.time()))
+            if files is not None:
+                conn.execute('DELETE FROM files WHERE package = ?',
+                             (pkg.name,))
+                conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                                 '(?, ?, ?)',
+                                 [(path, pkg.name, h) for path, h in files])
+        remove_files(stale)
+
+    # Files about to be installed by a package that another installed
+    # package has installed with different contents, as (path, owner) pairs
+    def conflicts(self, name, files):
+        ret = []
+        with self.connect() as conn:
+            if conn is None:
+                return ret
+            for path, h in files:
+                if is_shared(path):
+                    continue
+                row = conn.execute('SELECT package, hash FROM files '
+                                   'WHERE path = ?', (path,)).fetchone()
+                if row is not None and row[0] != name and row[1] != h:
+                    ret.append((path, row[0]))
+        return ret
+
+    def remove(self, name):
+        with self.connect(write=True) as conn:
+            conn.execute('DELETE FROM files WHERE package = ?', (name,))
+            conn.execute('DELETE FROM packages WHERE name = ?', (name,))
+
+    # Files of a package that are missing or differ from when they were
+    # installed, as (path, problem) pairs
+    def verify(self, name):
+        ret = []
+        for path, h in self.files(name):
+            if not os.path.lexists(path):
+                ret.append((path, 'missing'))
+            elif file_hash(path) != h:
+                ret.append((path, 'modified'))
+        return ret
+
+    # Delete the files of a package and any directories left empty
+    def uninstall(self, name):
+        removed = remove_files([path for path, h in self.files(name)])
+        self.remove(name)
+        return removed
+
+# The manifest is kept in `${localstatedir}/lib/gnukit'
+def db_path(build_conf):
+    config = configparser.ConfigParser(interpolation=
+                                       configparser.ExtendedInterpolation())
+    config.read_string(registry.gen_installdirs(build_conf))
+    return os.path.join(config['InstallDirs']['localstatedir'], 'lib',
+                        'gnukit', 'installed.db')
+
+# The manifest of the installation directories of a configuration, once set
+# up with setup()
+def get(build_conf):
+    return manifests.get(db_path(build_conf))
+
+def setup(build_conf):
+    global db
+    path = db_path(build_conf)
+    if path not in manifests:
+        manifests[path] = Manifest(path)
+    db = manifests[path]
+    return db
@@ -0,0 +1,199 @@
+# metrics.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+report = None
+
+# The phase being recorded by each thread, so that processes and downloads
+# are attributed to the package that started them
+current = threading.local()
+
+def format_time(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm%02ds' % (seconds // 3600, seconds // 60 % 60,
+                              seconds % 60)
+
+# Wall time, CPU time of child processes and peak child memory usage of
+# every phase run for each package, along with the amount of data downloaded
+class Report:
+    def __init__(self):
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.packages = {}
+        self.downloaded = 0
+
+    def __package(self, name):
+        try:
+            return self.packages[name]
+        except KeyError:
+            entry = self.packages[name] = {
+                'result': None,
+                'wall': 0.0,
+                'phases': []
+            }
+            return entry
+
+    def add_phase(self, name, record):
+        with self.lock:
+            self.__package(name)['phases'].append(record)
+
+    def add_time(self, name, wall):
+        with self.lock:
+            self.__package(name)['wall'] += wall
+
+    def set_result(self, name, result):
+        with self.lock:
+            self.__package(name)['result'] = result
+
+    def annotate(self, name, key, value):
+        with self.lock:
+            self.__package(name)[key] = value
+
+    def add_downloaded(self, size):
+        with self.lock:
+            self.downloaded += size
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    # The `count' phases that took the longest, as (package, phase) pairs
+    def slowest(self, count):
+        phases = [(name, record) for name, entry in self.packages.items()
+                  for record in entry['phases']]
+        phases.sort(key=lambda x: x[1]['wall'], reverse=True)
+        return phases[:count]
+
+    # Critical path of the build plan, weighing each package by the time it
+    # actually took to build
+    def critical_path(self, plan):
+        weights = {}
+        for name in plan.order:
+            entry = self.packages.get(name)
+            weights[name] = entry['wall'] if entry is not None else 0
+        return plan.critical_path(weights)
+
+    def to_json(self, plan=None):
+        ret = {
+            'started': self.started,
+            'elapsed': self.elapsed(),
+            'downloaded': self.downloaded,
+            'packages': self.packages
+        }
+        if plan is not None:
+            path, total = self.critical_path(plan)
+            ret['critical_path'] = {'packages': path, 'wall': total}
+        return ret
+
+    def write(self, path, plan=None):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_json(plan), f, indent=2)
+        os.replace(tmp, path)
+
+# Record a phase of a package run by the current thread
+@contextlib.contextmanager
+def phase(name, phase_name):
+    if report is None:
+        yield
+        return
+    record = {
+        'phase': phase_name,
+        'wall': 0.0,
+        'user': 0.0,
+        'sys': 0.0,
+        'maxrss': 0,
+        'downloaded': 0,
+        'failed': False,
+        'processes': []
+    }
+    prev = getattr(current, 'record', None)
+    current.record = record
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        record['wall'] = time.monotonic() - start
+        current.record = prev
+        report.add_phase(name, record)
+
+# Record the total time spent running a package
+@contextlib.contextmanager
+def package(name):
+    if report is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        report.add_time(name, time.monotonic() - start)
+
+# Record a finished child process from its resource usage as returned by
+# os.wait4(). The peak memory usage is recorded in kilobytes.
+def process(args, wall, usage, status):
+    record = getattr(current, 'record', None)
+    if record is None:
+        return
+    maxrss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        # Darwin reports bytes instead of kilobytes
+        maxrss //= 1024
+    record['user'] += usage.ru_utime
+    record['sys'] += usage.ru_stime
+    record['maxrss'] = max(record['maxrss'], maxrss)
+    record['processes'].append({
+        'args': args,
+        'wall': wall,
+        'user': usage.ru_utime,
+        'sys': usage.ru_stime,
+        'maxrss': maxrss,
+        'status': status
+    })
+
+def downloaded(size):
+    if report is None:
+        return
+    report.add_downloaded(size)
+    record = getattr(current, 'record', None)
+    if record is not None:
+        record['downloaded'] += size
+
+def annotate(name, key, value):
+    if report is not None:
+        report.annotate(name, key, value)
+
+def result(name, value):
+    if report is not None:
+        report.set_result(name, value)
+
+def setup():
+    global report
+    report = Report()
+    return report
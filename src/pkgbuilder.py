@@ -14,26 +14,64 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
-import configparser
+import cache
+import compcache
+import confcache
+import config as buildconfig
 import console
 import errno
+import extract
+import fetcher
 import hashlib
-import multiprocessing
+import jobserver
+import logs
+import manifest
+import metrics
 import os
+import prefetch
+import registry
 import shutil
+import staging
 import subprocess
 import sys
-import tarfile
-import textwrap
-import urllib.request
+import threading
+import time
+import workspace
 
-built = []
-listed = []
-confirm_notes = []
 successes = 0
 skips = 0
 failures = 0
 
+INSTALLDIRS = [
+    'prefix',
+    'eprefix',
+    'bindir',
+    'sbindir',
+    'libexecdir',
+    'sysconfdir',
+    'sharedstatedir',
+    'localstatedir',
+    'runstatedir',
+    'libdir',
+    'includedir',
+    'datadir',
+    'infodir',
+    'localedir',
+    'mandir',
+    'docdir'
+]
+
+# Phases with stamps, in the order they run
+PHASES = ['extract', 'configure', 'build', 'test', 'install']
+
+# Phases done once for every variant of a package
+SHARED_PHASES = ['fetch', 'extract']
+
+# Variants of a package share its extracted sources, which only one of them
+# may extract at a time
+tree_locks = {}
+tree_locks_lock = threading.Lock()
+
 GNU_INSTALLDIRS = {
     'prefix': '--prefix',
     'eprefix': '--exec-prefix',
@@ -67,30 +105,68 @@ def mkdir(name, empty=True):
         console.error('failed to create directory `%s\': %s' %
                       (name, os.strerror(e.errno)))
 
-def exec_process(args, env=None):
-    print(' '.join(args))
+# Environment of a command run for a package. Packages that set their own
+# variables only inherit the search path.
+def process_env(env=None):
     if env:
+        env = dict(env)
         env['PATH'] = os.getenv('PATH', '/usr/local/bin:/usr/bin')
-        subprocess.check_call(args, stdout=sys.stdout, stderr=sys.stderr,
-                              env=env)
     else:
-        subprocess.check_call(args, stdout=sys.stdout, stderr=sys.stderr)
+        env = dict(os.environ)
+    compcache.wrap(env)
+    return env
 
-class AlreadyInstalled(RuntimeError):
-    pass
+def exec_process(args, env=None, cwd=None, jobs=None, destdir=None):
+    log = logs.log()
+    if log is None:
+        print(' '.join(args))
+    else:
+        log.message(' '.join(args))
+    env = process_env(env)
+    if destdir:
+        env['DESTDIR'] = destdir
+    fds = ()
+    if jobs is not None:
+        env.update(jobs.env())
+        fds = jobs.fds()
+    start = time.monotonic()
+    if log is None:
+        proc = subprocess.Popen(args, stdout=sys.stdout, stderr=sys.stderr,
+                                env=env, cwd=cwd, pass_fds=fds)
+    else:
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, env=env, cwd=cwd,
+                                pass_fds=fds)
+        reader = log.reader(proc.stdout)
+    # Reap the process directly to get the resource usage of it and of
+    # everything it waited for
+    status, usage = os.wait4(proc.pid, 0)[1:]
+    if log is not None:
+        reader.finish()
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    metrics.process(args, time.monotonic() - start, usage, proc.returncode)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args)
 
 class Package:
-    def __setup_build(self, config):
+    def __setup_build(self, options):
         if self.buildsys == 'GNU':
-            self.configure_args = config['build.GNU']['configure_args']
+            self.configure_args = options['configure_args']
+            try:
+                self.configure_cache = options['configure_cache'] == 'true'
+            except KeyError:
+                self.configure_cache = True
         elif self.buildsys == 'make':
-            self.test_target = config['build.make']['test_target']
+            self.test_target = options['test_target']
         elif self.buildsys == 'meson':
-            self.meson_args = config['build.meson']['meson_args']
+            self.meson_args = options['meson_args']
         elif self.buildsys == 'script':
             try:
-                self.need_configure = \
-                    config['build.script']['configure'] == 'true'
+                self.need_configure = options['configure'] == 'true'
             except KeyError:
                 self.need_configure = False
             self.script = os.path.realpath('../pkg/%s.sh' % self.name)
@@ -99,122 +175,229 @@ class Package:
                           self.name)
             raise ValueError
 
-    def __defattr(self, attr, default):
-        value = getattr(self.config, attr)
-        return '%s = %s' % (attr, value if value else default)
-
-    def __gen_installdirs(self):
-        ret = ['[InstallDirs]']
-        ret.append(self.__defattr('prefix', '/usr/local'))
-        ret.append(self.__defattr('eprefix', '${prefix}'))
-        ret.append(self.__defattr('bindir', '${eprefix}/bin'))
-        ret.append(self.__defattr('sbindir', '${eprefix}/sbin'))
-        ret.append(self.__defattr('libexecdir', '${eprefix}/libexec'))
-        ret.append(self.__defattr('sysconfdir', '${prefix}/etc'))
-        ret.append(self.__defattr('sharedstatedir', '${prefix}/com'))
-        ret.append(self.__defattr('localstatedir', '${prefix}/var'))
-        ret.append(self.__defattr('runstatedir', '${localstatedir}/run'))
-        ret.append(self.__defattr('libdir', '${eprefix}/lib'))
-        ret.append(self.__defattr('includedir', '${prefix}/include'))
-        ret.append(self.__defattr('datadir', '${prefix}/share'))
-        ret.append(self.__defattr('infodir', '${datadir}/info'))
-        ret.append(self.__defattr('localedir', '${datadir}/locale'))
-        ret.append(self.__defattr('mandir', '${datadir}/man'))
-        ret.append(self.__defattr('docdir', '${datadir}/doc'))
-        return '\n'.join(ret)
-
-    def __init__(self, name, build_conf, warn_installed=True):
-        config = configparser.ConfigParser(interpolation=
-                                           configparser.ExtendedInterpolation())
+    def __init__(self, name, build_conf):
         self.config = build_conf
-        config.read_string(self.__gen_installdirs())
-        if not config.read('../pkg/%s.conf' % name):
+        record = registry.lookup(name, build_conf)
+        if record is None:
             console.warn('no package `%s\' found in registry' % name)
             raise ValueError
+        self.conf = os.path.realpath(registry.conf_path(name))
         if os.path.isfile('../pkg/%s.patch' % name):
             self.patch = os.path.realpath('../pkg/%s.patch' % name)
         else:
             self.patch = None
 
-        self.name = config['Package']['name']
-        self.version = config['Package']['version']
-        if warn_installed and os.path.isfile(config['Package']['installed']):
-            console.warn('%s-%s appears to already be installed' %
-                         (self.name, self.version))
-            if not self.config.ignore_installed:
-                raise AlreadyInstalled
-
-        self.buildsys = config['Package']['build']
-        self.srcdir = config['Package']['srcdir']
-        self.md5 = config['Package']['md5']
-        self.dependencies = config['Package']['dependencies'].split()
-        self.urls = config['URLs'].values()
-        self.__setup_build(config)
-
-        try:
-            self.confirm_notes = config['Package']['notes']
-        except KeyError:
-            self.confirm_notes = None
+        self.name = record.name
+        self.version = record.version
+        self.installed = record.installed
+        self.buildsys = record.build
+        self.srcdir = record.srcdir
+        self.md5 = record.md5
+        self.dependencies = list(record.dependencies)
+        if record.job_memory:
+            self.job_memory = buildconfig.parse_size(record.job_memory)
+        else:
+            self.job_memory = 0
+        self.urls = record.urls
+        self.script = None
+        self.workdir = os.path.realpath(self.name)
+        self.variant = build_conf.variant
+        if self.variant:
+            self.id = '%s:%s' % (self.name, self.variant)
+            self.fullname = '%s-%s (%s)' % (self.name, self.version,
+                                            self.variant)
+            # Stamps, logs and staged files of the variant
+            self.statedir = os.path.join(self.workdir, '.variants',
+                                         self.variant)
+        else:
+            self.id = self.name
+            self.fullname = '%s-%s' % (self.name, self.version)
+            self.statedir = self.workdir
+        self.set_treedir(self.workdir)
+        self.stagedir = os.path.join(self.statedir, 'stage')
+        self.manifest = manifest.get(build_conf)
+        self.build_key = None
+        self.fingerprint = None
+        self.build_fingerprint = None
+        self.__setup_build(dict(record.options))
+        self.confirm_notes = record.notes
 
         self.env = {}
+        for var in record.env.split():
+            pair = var.split('=')
+            self.env[pair[0]] = '='.join(pair[1:])
+
+    # Set the directory holding the extracted sources and build directory,
+    # which is the work directory unless it is in the scratch directory
+    def set_treedir(self, path):
+        self.treedir = path
+        if self.variant:
+            self.builddir = os.path.join(path, 'build-' + self.variant)
+        else:
+            self.builddir = os.path.join(path, 'build')
+
+    def __stamp_dir(self, phase):
+        if phase in SHARED_PHASES:
+            return os.path.join(self.workdir, '.stamps')
+        return os.path.join(self.statedir, '.stamps')
+
+    def __read_stamp(self, phase):
         try:
-            env = config['Package']['env'].split()
-            for var in env:
-                pair = var.split('=')
-                self.env[pair[0]] = '='.join(pair[1:])
-        except KeyError:
-            pass
+            with open(os.path.join(self.__stamp_dir(phase), phase)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
 
-    def fetch(self):
-        if os.path.isfile('archive'):
-            with open('archive', 'rb') as f:
-                md5 = hashlib.md5(f.read()).hexdigest()
-            if md5 != self.md5:
+    def __write_stamp(self, phase, value):
+        stamps = self.__stamp_dir(phase)
+        os.makedirs(stamps, exist_ok=True)
+        tmp = os.path.join(stamps, phase + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(value)
+        os.replace(tmp, os.path.join(stamps, phase))
+
+    # Run a phase of the build unless its stamp shows that it already ran
+    # with the same inputs and its output still exists. Each fingerprint also
+    # covers the one of the phase before it, so rerunning a phase reruns all
+    # of the phases after it.
+    def __phase(self, phase, inputs, output, func, chain=True):
+        h = hashlib.sha256(('%s\0%s' % (self.fingerprint, phase)).encode())
+        for value in inputs:
+            h.update(('\0%s' % value).encode())
+        fingerprint = h.hexdigest()
+        if self.__read_stamp(phase) != fingerprint or \
+           not os.path.exists(output):
+            # The outputs of later phases are stale even if their inputs did
+            # not change, such as when the sources had to be extracted again
+            # for every variant
+            stamps = [self.__stamp_dir(phase)]
+            if phase in SHARED_PHASES:
+                variants = os.path.join(self.workdir, '.variants')
+                if os.path.isdir(variants):
+                    stamps += [os.path.join(variants, v, '.stamps')
+                               for v in os.listdir(variants)]
+            for later in PHASES[PHASES.index(phase) + 1:] if chain else []:
+                for d in stamps:
+                    try:
+                        os.unlink(os.path.join(d, later))
+                    except FileNotFoundError:
+                        pass
+            with metrics.phase(self.id, phase):
+                func()
+            self.__write_stamp(phase, fingerprint)
+        if chain:
+            self.fingerprint = fingerprint
+
+    # Stamp of a verified archive, which stays valid as long as the archive
+    # is not touched
+    def __archive_stamp(self, archive):
+        st = os.stat(archive)
+        return '%s %d %d' % (self.md5, st.st_size, st.st_mtime_ns)
+
+    def download(self):
+        with metrics.phase(self.id, 'fetch'):
+            self.__download()
+
+    def __download(self):
+        mkdir(self.workdir, empty=False)
+        archive = os.path.join(self.workdir, 'archive')
+        if os.path.isfile(archive):
+            # Avoid hashing the archive again if it has not been touched
+            # since it was last verified
+            stamp = self.__archive_stamp(archive)
+            if self.__read_stamp('fetch') == stamp:
+                return
+            if fetcher.md5sum(archive) != self.md5:
                 print('  Bad archive MD5 checksum, re-downloading')
-                os.unlink('archive')
+                os.unlink(archive)
             else:
+                self.__write_stamp('fetch', stamp)
                 return
+        if cache.sources is not None and \
+           cache.sources.fetch(self.md5, archive,
+                               lambda path: fetcher.md5sum(path) == self.md5):
+            print('Using cached archive for %s-%s' % (self.name, self.version))
+            self.__write_stamp('fetch', self.__archive_stamp(archive))
+            return
         print('Downloading %s-%s' % (self.name, self.version))
-        for url in self.urls:
+        for name in os.listdir(self.workdir):
+            if name.startswith('.extract'):
+                shutil.rmtree(os.path.join(self.workdir, name))
+        for url in fetcher.rank_mirrors(self.urls):
+            print('  Attempting to download archive from ' + url)
+            # Extract the archive while it downloads, it is only used once
+            # the checksum has been verified
+            tmp = os.path.join(self.workdir, '.extract-tmp')
+            sink = extract.StreamExtractor(tmp)
             try:
-                print('  Attempting to download archive from ' + url)
-                with urllib.request.urlopen(url) as f:
-                    data = f.read()
-                md5 = hashlib.md5(data).hexdigest()
-                if md5 != self.md5:
-                    print('  Bad MD5 checksum: got ' + md5)
-                    print('               expected ' + self.md5)
-                    continue
-                with open('archive', 'wb') as f:
-                    f.write(data)
-            except urllib.error.HTTPError:
-                pass # Try another URL
+                fetcher.download(url, archive, self.md5, sink)
+            except fetcher.ChecksumError as e:
+                sink.abort()
+                print('  Bad MD5 checksum: got ' + e.md5)
+                print('               expected ' + self.md5)
+            except OSError as e:
+                sink.abort()
+                print('  Download failed: %s' % e)
             else:
+                if sink.finish():
+                    os.rename(tmp, os.path.join(self.workdir,
+                                                '.extracted-' + self.md5))
+                if cache.sources is not None:
+                    try:
+                        cache.sources.store(archive, self.md5)
+                    except OSError as e:
+                        console.warn('failed to store `%s\' in the source '
+                                     'cache: %s' % (self.name, e))
+                self.__write_stamp('fetch', self.__archive_stamp(archive))
                 return
         console.warn('package `%s\' could not be fetched' % self.name)
         raise ValueError
 
-    def extract(self):
-        if os.path.isdir(self.srcdir):
-            return
-        if os.path.isfile(self.srcdir):
-            os.unlink(self.srcdir)
-        print('Extracting %s-%s' % (self.name, self.version))
-        with tarfile.open('archive') as f:
-            f.extractall('.')
+    def fetch(self):
+        if prefetch.prefetcher is not None:
+            prefetch.prefetcher.wait(self)
+        else:
+            self.download()
+        self.fingerprint = self.md5
+
+    def __extract(self):
+        # Remove any sources left from a different archive or patch
+        top = os.path.join(self.treedir, self.srcdir.split('/')[0])
+        if os.path.isdir(top):
+            shutil.rmtree(top)
+        elif os.path.lexists(top):
+            os.unlink(top)
+        streamed = os.path.join(self.workdir, '.extracted-' + self.md5)
+        if os.path.isdir(streamed):
+            print('Extracting %s-%s (unpacked while downloading)' %
+                  (self.name, self.version))
+            for name in os.listdir(streamed):
+                dest = os.path.join(self.treedir, name)
+                if os.path.isdir(dest):
+                    shutil.rmtree(dest)
+                # The tree may be on another filesystem
+                shutil.move(os.path.join(streamed, name), dest)
+            os.rmdir(streamed)
+        else:
+            print('Extracting %s-%s' % (self.name, self.version))
+            extract.extract_archive(os.path.join(self.workdir, 'archive'),
+                                    self.treedir)
         # Apply a patch, if any
         if self.patch is not None:
-            os.chdir(self.srcdir)
-            exec_process(['patch', '-p', '1', '-i', self.patch])
-            os.chdir('..')
-        mkdir('build')
+            exec_process(['patch', '-p', '1', '-i', self.patch],
+                         cwd=os.path.join(self.treedir, self.srcdir))
+        mkdir(self.builddir)
 
-    def configure(self):
-        if self.buildsys == 'make':
-            return
-        if self.buildsys == 'script' and not self.need_configure:
-            return
-        print('\nConfiguring %s-%s' % (self.name, self.version))
+    def extract(self):
+        patch = fetcher.md5sum(self.patch) if self.patch is not None else ''
+        with tree_locks_lock:
+            lock = tree_locks.setdefault(self.workdir, threading.Lock())
+        with lock:
+            self.__phase('extract', [patch],
+                         os.path.join(self.treedir, self.srcdir),
+                         self.__extract)
+
+    def configure_command(self):
         if self.buildsys == 'GNU':
             conf_args = ['../%s/configure' % self.srcdir]
             for d in ['build', 'host', 'target']:
@@ -231,7 +414,8 @@ class Package:
                         pass # TODO Don't pass --runstatedir if unsupported
                     conf_args.append(arg)
             conf_args.extend(self.configure_args.split())
-            exec_process(conf_args, self.env)
+            conf_args.extend(self.config.variant_configure_args.split())
+            return conf_args
         elif self.buildsys == 'meson':
             conf_args = ['meson']
             # TODO Meson cross-compilation support
@@ -244,107 +428,273 @@ class Package:
                         continue
                     conf_args.append(arg)
             conf_args.extend(self.meson_args.split())
+            conf_args.extend(self.config.variant_meson_args.split())
             conf_args.append('../' + self.srcdir)
-            exec_process(conf_args, self.env)
+            return conf_args
+        elif self.buildsys == 'script' and self.need_configure:
+            return ['sh', self.script, 'configure']
+        return None
+
+    def __configure(self):
+        conf_args = self.configure_command()
+        if conf_args is None:
+            # The sources may have been extracted for another variant
+            mkdir(self.builddir, empty=False)
+            return
+        # Configure from scratch, meson refuses to reconfigure a build
+        # directory with different options
+        mkdir(self.builddir)
+        logs.status('Configuring ' + self.fullname)
+        if self.buildsys != 'GNU' or not self.configure_cache or \
+           not confcache.enabled:
+            exec_process(conf_args, self.env, self.builddir, self.jobs)
+            return
+        shared = confcache.ConfigCache(confcache.cache_key(
+            self.config, process_env(self.env), self.env))
+        cache_file = os.path.join(self.builddir, 'config.cache')
+        shared.copy_to(cache_file)
+        try:
+            exec_process(conf_args + ['--cache-file=' + cache_file],
+                         self.env, self.builddir, self.jobs)
+        except subprocess.CalledProcessError:
+            # A result cached by another package may not suit this one
+            mkdir(self.builddir)
+            logs.status('Configuring %s again without the shared cache' %
+                        self.fullname)
+            exec_process(conf_args, self.env, self.builddir, self.jobs)
+            return
+        shared.merge(cache_file)
+
+    def configure(self):
+        env = ['%s=%s' % (k, self.env[k]) for k in sorted(self.env)]
+        if compcache.name():
+            # The compilers found by configure depend on the compiler cache
+            env.append('compiler_cache=' + compcache.name())
+        # The build key changes with the package configuration and with the
+        # builds of its dependencies, which all need a rebuild against them
+        self.__phase('configure', (self.configure_command() or []) + env +
+                     [self.script_hash(), self.build_key], self.builddir,
+                     self.__configure)
+
+    def script_hash(self):
+        if self.script is None:
+            return ''
+        return fetcher.md5sum(self.script)
+
+    def __build(self):
+        logs.status('Building ' + self.fullname)
+        if self.buildsys == 'GNU':
+            exec_process(['make'], cwd=self.builddir, jobs=self.jobs)
+        elif self.buildsys == 'make':
+            exec_process(['make', '-C', '../' + self.srcdir],
+                         cwd=self.builddir, jobs=self.jobs)
+        elif self.buildsys == 'meson':
+            exec_process(['ninja'] + self.jobs.ninja_args(),
+                         cwd=self.builddir, jobs=self.jobs)
         elif self.buildsys == 'script':
-            exec_process(['sh', self.script, 'configure'], self.env)
+            exec_process(['sh', self.script, 'build'], self.env, self.builddir,
+                         self.jobs)
 
     def build(self):
-        os.chdir('build')
-        if not os.path.isfile('config.status'):
-            self.configure()
-        print('\nBuilding %s-%s' % (self.name, self.version))
+        self.__phase('build', [], self.builddir, self.__build)
+
+    def __test(self):
+        logs.status('Running unit tests for ' + self.fullname)
         if self.buildsys == 'GNU':
-            exec_process(['make', '-j', str(multiprocessing.cpu_count())])
+            exec_process(['make', 'check'], cwd=self.builddir, jobs=self.jobs)
         elif self.buildsys == 'make':
-            exec_process(['make', '-j', str(multiprocessing.cpu_count()),
-                          '-C', '../' + self.srcdir])
+            exec_process(['make', '-C', '../' + self.srcdir, self.test_target],
+                         cwd=self.builddir, jobs=self.jobs)
         elif self.buildsys == 'meson':
-            exec_process(['ninja'])
+            exec_process(['ninja', 'test'] + self.jobs.ninja_args(),
+                         cwd=self.builddir, jobs=self.jobs)
         elif self.buildsys == 'script':
-            exec_process(['sh', self.script, 'build'], self.env)
+            exec_process(['sh', self.script, 'test'], self.env, self.builddir,
+                         self.jobs)
 
     def test(self):
-        self.build()
         if not self.config.run_tests:
             return
-        print('\nRunning unit tests for %s-%s' % (self.name, self.version))
-        if self.buildsys == 'GNU':
-            exec_process(['make', 'check'])
-        elif self.buildsys == 'make':
-            exec_process(['make', '-C', '../' + self.srcdir, self.test_target])
-        elif self.buildsys == 'meson':
-            exec_process(['ninja', 'test'])
-        elif self.buildsys == 'script':
-            exec_process(['sh', self.script, 'test'], self.env)
+        # Tests do not change what gets installed, so they are left out of
+        # the fingerprints of later phases
+        self.__phase('test', [], self.builddir, self.__test, chain=False)
 
-    def install(self):
-        self.test()
-        print('\nInstalling %s-%s' % (self.name, self.version))
+    def __install(self):
+        logs.status('Installing ' + self.fullname)
+        # Installations are staged so that the installed files can be
+        # recorded and stored in the artifact cache before being moved into
+        # place
+        destdir = self.stagedir
+        mkdir(destdir)
         if self.buildsys == 'GNU':
-            exec_process(['make', 'install'])
+            exec_process(['make', 'install'], cwd=self.builddir,
+                         jobs=self.jobs, destdir=destdir)
         elif self.buildsys == 'make':
-            exec_process(['make', '-C', '../' + self.srcdir, 'install'])
+            exec_process(['make', '-C', '../' + self.srcdir, 'install'],
+                         cwd=self.builddir, jobs=self.jobs, destdir=destdir)
         elif self.buildsys == 'meson':
-            exec_process(['ninja', 'install'])
+            exec_process(['ninja', 'install'] + self.jobs.ninja_args(),
+                         cwd=self.builddir, jobs=self.jobs, destdir=destdir)
         elif self.buildsys == 'script':
-            exec_process(['sh', self.script, 'install'], self.env)
-
-    def add_confirm_notes(self):
-        global confirm_notes
-        for d in self.dependencies:
-            if d in listed:
-                continue
-            dpkg = Package(d, self.config, warn_installed=False)
-            if dpkg is not None:
-                dpkg.add_confirm_notes()
-        if self.name not in listed and self.confirm_notes is not None:
-            confirm_notes.append('\n%s-%s:' % (self.name, self.version))
-            lines = textwrap.wrap(self.confirm_notes, 74,
-                                  break_long_words=False)
-            confirm_notes.extend(['  ' + l for l in lines])
-        listed.append(self.name)
-
-    def run(self):
-        global successes
-        global skips
-        global failures
-        for d in self.dependencies:
-            if d in built:
-                continue
+            exec_process(['sh', self.script, 'install'], self.env,
+                         self.builddir, self.jobs, destdir)
+        if staging.is_empty(destdir):
+            console.warn('package `%s\' did not install into the staging '
+                         'directory,\nnot recording its files or storing it '
+                         'in the artifact cache' % self.name)
+            self.manifest.record(self)
+            return
+        files = manifest.staged_files(destdir)
+        self.__check_conflicts(files)
+        if cache.artifacts is not None:
+            artifact = os.path.join(self.statedir, 'artifact.tar.gz')
             try:
-                dpkg = Package(d, self.config)
-            except AlreadyInstalled:
-                skips += 1
-                built.append(d)
-                continue
-            if dpkg is None:
-                failures += 1
-                console.warn('unknown dependency ' + d)
-                raise ValueError
+                staging.pack(destdir, artifact)
+                cache.artifacts.store(artifact, self.build_key)
+            except OSError as e:
+                # The package is installed all the same, it is just built
+                # again next time
+                console.warn('failed to store `%s\' in the artifact cache: '
+                             '%s' % (self.name, e))
+            finally:
+                try:
+                    os.unlink(artifact)
+                except FileNotFoundError:
+                    pass
+        self.__merge(files)
+
+    # Check that the staged files do not replace files installed by another
+    # package with different contents, which is only allowed with
+    # `file_conflicts = overwrite'. This is done before anything is stored
+    # or installed.
+    def __check_conflicts(self, files, report=True):
+        conflicts = self.manifest.conflicts(self.name, files)
+        if conflicts and self.config.file_conflicts == 'error':
+            for path, owner in conflicts:
+                console.warn('package `%s\' conflicts with `%s\' over %s' %
+                             (self.name, owner, path))
+            raise ValueError
+        for path, owner in conflicts if report else []:
+            console.warn('package `%s\' overwrites %s installed by `%s\'' %
+                         (self.name, path, owner))
+
+    # Move the staged installation into place and record its files, once
+    # they have been checked for conflicts
+    def __merge(self, files):
+        merge = staging.Merge(self.stagedir, 'gnukit-' + self.id)
+        try:
+            merge.prepare()
+            with self.manifest.lock():
+                # Check again for packages installed in the meantime
+                self.__check_conflicts(files, report=False)
+                merge.commit()
+                self.manifest.record(self, files)
+        finally:
+            merge.abort()
+        shutil.rmtree(self.stagedir)
+
+    def install(self):
+        self.__phase('install', [getattr(self.config, d)
+                                 for d in INSTALLDIRS],
+                     self.installed, self.__install)
+
+    # Compute a hash identifying everything that affects the installed files
+    # of the package, given the build keys of its dependencies
+    def compute_build_key(self, dep_keys):
+        h = hashlib.sha256()
+        for path in [self.conf, self.patch, self.script]:
+            if path is not None and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+            h.update(b'\0')
+        for d in INSTALLDIRS + ['build', 'host', 'target']:
+            h.update(('%s=%s\0' % (d, getattr(self.config, d))).encode())
+        for d in ['variant_configure_args', 'variant_meson_args']:
+            if getattr(self.config, d):
+                h.update(('%s=%s\0' % (d, getattr(self.config, d))).encode())
+        for k in sorted(self.env):
+            h.update(('%s=%s\0' % (k, self.env[k])).encode())
+        if compcache.name():
+            h.update(('compiler_cache=%s\0' % compcache.name()).encode())
+        for d in sorted(dep_keys):
+            h.update(('%s=%s\0' % (d, dep_keys[d])).encode())
+        self.build_key = h.hexdigest()
+
+    def cached(self):
+        return cache.artifacts is not None and \
+            os.path.isfile(cache.artifacts.path(self.build_key))
+
+    # Install the package from the artifact cache, returning whether it was
+    # found there
+    def install_cached(self):
+        if cache.artifacts is None:
+            return False
+        os.makedirs(self.statedir, exist_ok=True)
+        artifact = os.path.join(self.statedir, 'artifact.tar.gz')
+        if not cache.artifacts.fetch(self.build_key, artifact):
+            return False
+        print('Installing cached build of ' + self.fullname)
+        with metrics.phase(self.id, 'install-cached'):
+            mkdir(self.stagedir)
             try:
-                print('Attempting to build %s-%s dependency %s-%s' %
-                      (self.name, self.version, dpkg.name, dpkg.version))
-                dpkg.run()
-            except:
-                failures += 1
-                console.warn('failed to build dependency %s-%s' %
-                             (dpkg.name, dpkg.version))
-                raise ValueError
-            else:
-                successes += 1
-                built.append(d)
-        cwd = os.getcwd()
-        mkdir(self.name, empty=False)
-        os.chdir(self.name)
-        self.fetch()
+                staging.unpack(artifact, self.stagedir)
+            except ValueError as e:
+                console.warn('%s, building `%s\' instead' % (e, self.name))
+                cache.artifacts.remove(self.build_key)
+                return False
+            finally:
+                os.unlink(artifact)
+            files = manifest.staged_files(self.stagedir)
+            self.__check_conflicts(files)
+            self.__merge(files)
+        return True
+
+    # Build and install the package, calling `installed' once it is
+    # installed. With background tests, the tests run after that so that
+    # packages depending on this one do not have to wait for them.
+    def run(self, installed=None):
+        # Dependencies are built beforehand by the scheduler, so this only
+        # needs to build the package itself
+        with metrics.package(self.id), logs.package(self), \
+             compcache.package(self):
+            if self.install_cached():
+                if installed is not None:
+                    installed()
+                return
+            self.fetch()
+            with workspace.tree(self):
+                try:
+                    self.__build_tree()
+                except (ValueError, subprocess.CalledProcessError):
+                    if not workspace.spill(self):
+                        raise
+                    self.fingerprint = self.md5
+                    self.__build_tree()
+                if installed is not None:
+                    installed()
+                if self.config.background_tests:
+                    self.fingerprint = self.build_fingerprint
+                    with self.reserve_jobs() as self.jobs:
+                        self.test()
+
+    # ninja takes part in the jobserver only with the FIFO protocol
+    def reserve_jobs(self):
+        return jobserver.server.reserve(self.job_memory,
+                                        ninja=self.buildsys == 'meson')
+
+    def __build_tree(self):
         self.extract()
-        self.install()
-        os.chdir(cwd)
+        with self.reserve_jobs() as self.jobs:
+            self.configure()
+            self.build()
+            self.build_fingerprint = self.fingerprint
+            if not self.config.background_tests:
+                self.test()
+            self.install()
 
-def get_pkg(name, build_conf, warn_installed=True):
+def get_pkg(name, build_conf):
     try:
-        pkg = Package(name, build_conf, warn_installed)
+        pkg = Package(name, build_conf)
     except ValueError:
         pass
     except KeyError:
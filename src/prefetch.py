@@ -0,0 +1,73 @@
+# prefetch.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import console
+import fetcher
+
+prefetcher = None
+
+# Downloads the archives of every package in the build plan in the
+# background, so that builds only have to wait for their own archive
+class Prefetcher:
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self.futures = {}
+
+    def start(self, pkgs):
+        for pkg in pkgs:
+            if pkg.workdir not in self.futures:
+                self.futures[pkg.workdir] = self.executor.submit(pkg.download)
+
+    # Block until the archive of a package has been downloaded, raising the
+    # same exception the download did if it failed
+    def wait(self, pkg):
+        try:
+            future = self.futures[pkg.workdir]
+        except KeyError:
+            pkg.download()
+        else:
+            future.result()
+
+    # Wait for all downloads, returning the number that succeeded and failed
+    def wait_all(self):
+        succeeded = 0
+        failed = 0
+        for future in concurrent.futures.as_completed(self.futures.values()):
+            try:
+                future.result()
+            except OSError as e:
+                console.warn(str(e))
+                failed += 1
+            except ValueError:
+                failed += 1
+            else:
+                succeeded += 1
+        return succeeded, failed
+
+    # Drop downloads that have not started yet and wait for the others
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown()
+
+def start(build_conf, pkgs):
+    global prefetcher
+    fetcher.host_connections = build_conf.max_host_connections
+    prefetcher = Prefetcher(build_conf.max_parallel_downloads)
+    prefetcher.start(pkgs)
+    return prefetcher
@@ -0,0 +1,164 @@
+# registry.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import configparser
+import hashlib
+import json
+import os
+
+REGISTRY = '../pkg'
+
+# Parsed contents of a package configuration file, with every value already
+# interpolated against the installation directories
+Record = collections.namedtuple('Record', [
+    'name',
+    'version',
+    'build',
+    'srcdir',
+    'md5',
+    'installed',
+    'dependencies',
+    'job_memory',
+    'urls',
+    'notes',
+    'env',
+    'options'
+])
+
+INSTALLDIR_DEFAULTS = [
+    ('prefix', '/usr/local'),
+    ('eprefix', '${prefix}'),
+    ('bindir', '${eprefix}/bin'),
+    ('sbindir', '${eprefix}/sbin'),
+    ('libexecdir', '${eprefix}/libexec'),
+    ('sysconfdir', '${prefix}/etc'),
+    ('sharedstatedir', '${prefix}/com'),
+    ('localstatedir', '${prefix}/var'),
+    ('runstatedir', '${localstatedir}/run'),
+    ('libdir', '${eprefix}/lib'),
+    ('includedir', '${prefix}/include'),
+    ('datadir', '${prefix}/share'),
+    ('infodir', '${datadir}/info'),
+    ('localedir', '${datadir}/locale'),
+    ('mandir', '${datadir}/man'),
+    ('docdir', '${datadir}/doc')
+]
+
+registries = {}
+
+def gen_installdirs(build_conf):
+    ret = ['[InstallDirs]']
+    for attr, default in INSTALLDIR_DEFAULTS:
+        value = getattr(build_conf, attr)
+        ret.append('%s = %s' % (attr, value if value else default))
+    return '\n'.join(ret)
+
+def conf_path(name):
+    return os.path.join(REGISTRY, name + '.conf')
+
+def parse(path, installdirs):
+    config = configparser.ConfigParser(interpolation=
+                                       configparser.ExtendedInterpolation())
+    config.read_string(installdirs)
+    if not config.read(path):
+        return None
+    pkg = config['Package']
+    options = ()
+    if config.has_section('build.' + pkg['build']):
+        options = tuple(config['build.' + pkg['build']].items())
+    return Record(name=pkg['name'],
+                  version=pkg['version'],
+                  build=pkg['build'],
+                  srcdir=pkg['srcdir'],
+                  md5=pkg['md5'],
+                  installed=pkg['installed'],
+                  dependencies=tuple(pkg['dependencies'].split()),
+                  job_memory=pkg.get('job_memory', ''),
+                  urls=tuple(config['URLs'].values()),
+                  notes=pkg.get('notes'),
+                  env=pkg.get('env', ''),
+                  options=options)
+
+def from_json(values):
+    record = Record(*values)
+    return record._replace(dependencies=tuple(record.dependencies),
+                           urls=tuple(record.urls),
+                           options=tuple(tuple(o) for o in record.options))
+
+# Package records parsed against one set of installation directories. Each
+# configuration file is parsed at most once per process, and the records are
+# saved to an index file so later runs only have to parse files whose
+# modification time or size changed.
+class Registry:
+    def __init__(self, installdirs):
+        self.installdirs = installdirs
+        # Changing the record layout also invalidates old index files
+        key = hashlib.sha256(('%s\n%s' % (' '.join(Record._fields),
+                                          installdirs)).encode())
+        key = key.hexdigest()[:16]
+        self.index_path = 'registry-%s.json' % key
+        self.records = {}
+        self.dirty = False
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def lookup(self, name):
+        try:
+            return self.records[name]
+        except KeyError:
+            pass
+        path = conf_path(name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.records[name] = None
+            return None
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = self.index.get(name)
+        if entry is not None and entry['stamp'] == stamp:
+            record = from_json(entry['record'])
+        else:
+            record = parse(path, self.installdirs)
+            if record is not None:
+                self.index[name] = {'stamp': stamp, 'record': record}
+                self.dirty = True
+        self.records[name] = record
+        return record
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+        self.dirty = False
+
+def lookup(name, build_conf):
+    installdirs = gen_installdirs(build_conf)
+    try:
+        reg = registries[installdirs]
+    except KeyError:
+        reg = registries[installdirs] = Registry(installdirs)
+    return reg.lookup(name)
+
+def save():
+    for reg in registries.values():
+        reg.save()
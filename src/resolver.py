@@ -0,0 +1,241 @@
+# resolver.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import console
+import os
+import pkgbuilder
+
+# The packages that need to be built for a set of requested packages, in an
+# order where every package comes after its dependencies
+class Plan:
+    def __init__(self):
+        self.order = []
+        self.packages = {}
+        self.deps = {}
+        self.installed = []
+        # Installed packages being rebuilt, with the version installed
+        self.upgrades = {}
+        self.missing = []
+        self.cycles = []
+        self.cancelled = []
+
+    def pkgs(self):
+        return [self.packages[name] for name in self.order]
+
+    def dependents(self):
+        ret = {name: [] for name in self.order}
+        for name in self.order:
+            for d in self.deps[name]:
+                ret[d].append(name)
+        return ret
+
+    # Number of packages on the longest chain of dependencies ending at each
+    # package, starting from 1 for packages with nothing left to build
+    def levels(self):
+        ret = {}
+        for name in self.order:
+            ret[name] = 1 + max([ret[d] for d in self.deps[name]], default=0)
+        return ret
+
+    # Number of packages on the largest level of levels(). None of them
+    # depend on each other, so they can all be built at the same time once
+    # the levels before are done. Packages of different levels can also be
+    # ready at once, so more packages may be built in parallel than this.
+    def width(self):
+        counts = {}
+        for level in self.levels().values():
+            counts[level] = counts.get(level, 0) + 1
+        return max(counts.values(), default=0)
+
+    # The chain of dependencies with the highest total weight, which bounds
+    # how quickly the plan can be built no matter how many packages are
+    # built in parallel. Each package weighs 1 unless given in `weights'.
+    def critical_path(self, weights=None):
+        if weights is None:
+            weights = {}
+        total = {}
+        prev = {}
+        for name in self.order:
+            best = None
+            for d in self.deps[name]:
+                if best is None or total[d] > total[best]:
+                    best = d
+            prev[name] = best
+            total[name] = weights.get(name, 1) + (total[best] if best else 0)
+        if not total:
+            return [], 0
+        end = max(self.order, key=lambda name: total[name])
+        path = []
+        name = end
+        while name is not None:
+            path.append(name)
+            name = prev[name]
+        path.reverse()
+        return path, total[end]
+
+    def to_json(self):
+        levels = self.levels()
+        path = self.critical_path()[0]
+        return {
+            'packages': [{
+                'name': name,
+                'version': self.packages[name].version,
+                'dependencies': self.deps[name],
+                'level': levels[name],
+                'build_key': self.packages[name].build_key
+            } for name in self.order],
+            'installed': self.installed,
+            'upgrades': self.upgrades,
+            'missing': self.missing,
+            'cycles': self.cycles,
+            'cancelled': self.cancelled,
+            'critical_path': path,
+            'width': self.width()
+        }
+
+class Resolver:
+    def __init__(self, build_conf):
+        self.config = build_conf
+        self.plan = Plan()
+        self.state = {}
+        self.failed = set()
+        # Build keys of installed packages that are not being rebuilt
+        self.installed_keys = {}
+
+    # Depth-first walk that loads each package once. The stack is kept
+    # explicitly so that a dependency cycle is reported instead of recursing
+    # forever.
+    def __visit(self, root):
+        plan = self.plan
+        stack = [(root, None)]
+        path = []
+        while stack:
+            name, deps = stack.pop()
+            if deps is None:
+                if name in self.state:
+                    if self.state[name] == 'visiting':
+                        cycle = path[path.index(name):] + [name]
+                        plan.cycles.append(cycle)
+                        console.warn('dependency cycle: ' + ' -> '.join(cycle))
+                        self.failed.update(cycle)
+                    continue
+                pkg = pkgbuilder.get_pkg(name, self.config)
+                if pkg is None:
+                    self.state[name] = 'done'
+                    plan.missing.append(name)
+                    self.failed.add(name)
+                    continue
+                # Packages recorded in the manifest are checked once the
+                # build keys of their dependencies are known
+                if os.path.isfile(pkg.installed) and \
+                   self.installed_record(pkg) is None:
+                    console.warn('%s-%s appears to already be installed' %
+                                 (pkg.name, pkg.version))
+                    if not self.config.ignore_installed:
+                        self.state[name] = 'done'
+                        plan.installed.append(name)
+                        continue
+                self.state[name] = 'visiting'
+                plan.packages[name] = pkg
+                path.append(name)
+                deps = list(pkg.dependencies)
+            if deps:
+                d = deps.pop(0)
+                stack.append((name, deps))
+                stack.append((d, None))
+                continue
+            # All dependencies visited
+            path.pop()
+            self.state[name] = 'done'
+            pkg = plan.packages[name]
+            plan.deps[name] = [d for d in pkg.dependencies
+                               if d in plan.packages]
+            if any(d in self.failed for d in pkg.dependencies):
+                if name not in self.failed:
+                    console.warn('package `%s\' cancelled, a dependency '
+                                 'cannot be built' % name)
+                    self.failed.add(name)
+                continue
+            pkg.compute_build_key({
+                d: plan.packages[d].build_key if d in plan.packages
+                else self.installed_keys.get(d, 'installed')
+                for d in pkg.dependencies
+            })
+            record = self.installed_record(pkg)
+            if record is not None and not self.config.ignore_installed:
+                version, build_key = record[:2]
+                if version == pkg.version and build_key == pkg.build_key:
+                    del plan.packages[name]
+                    del plan.deps[name]
+                    plan.installed.append(name)
+                    self.installed_keys[name] = build_key
+                    continue
+                plan.upgrades[name] = version
+            plan.order.append(name)
+
+    # The manifest entry of a package, if its files are still installed
+    def installed_record(self, pkg):
+        if pkg.manifest is None or not os.path.isfile(pkg.installed):
+            return None
+        return pkg.manifest.lookup(pkg.name)
+
+    def resolve(self, names):
+        for name in names:
+            self.__visit(name)
+        plan = self.plan
+        # Make sure nothing depending on a package that cannot be built, such
+        # as one in a dependency cycle, is left in the order
+        order = []
+        for name in plan.order:
+            if name in self.failed or \
+               any(d in self.failed for d in plan.deps[name]):
+                self.failed.add(name)
+            else:
+                order.append(name)
+        plan.order = order
+        for name in list(plan.packages):
+            if name in self.failed:
+                del plan.packages[name]
+                del plan.deps[name]
+                plan.cancelled.append(name)
+        return plan
+
+def resolve(names, build_conf):
+    return Resolver(build_conf).resolve(names)
+
+# Resolve the packages for each variant and combine the plans into one, in
+# which every package is named after its variant so that all of them can be
+# scheduled together
+def resolve_variants(names, confs):
+    if len(confs) == 1 and not confs[0].variant:
+        return resolve(names, confs[0])
+    plan = Plan()
+    for conf in confs:
+        part = resolve(names, conf)
+        def qualify(name):
+            return '%s:%s' % (name, conf.variant)
+        plan.order += [qualify(name) for name in part.order]
+        for name in part.order:
+            plan.packages[qualify(name)] = part.packages[name]
+            plan.deps[qualify(name)] = [qualify(d) for d in part.deps[name]]
+        plan.installed += [qualify(name) for name in part.installed]
+        for name, version in part.upgrades.items():
+            plan.upgrades[qualify(name)] = version
+        plan.missing += [qualify(name) for name in part.missing]
+        plan.cycles += [[qualify(name) for name in cycle]
+                        for cycle in part.cycles]
+        plan.cancelled += [qualify(name) for name in part.cancelled]
+    return plan
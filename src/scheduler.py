@@ -0,0 +1,193 @@
+# scheduler.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import console
+import functools
+import journal
+import metrics
+import pkgbuilder
+import subprocess
+
+# Node states
+PENDING = 0
+RUNNING = 1
+DONE = 2
+FAILED = 3
+
+class Node:
+    def __init__(self, name, pkg):
+        self.name = name
+        self.pkg = pkg
+        self.state = PENDING
+        self.waiting = 0
+        self.dependents = []
+        self.installed = None
+
+class Scheduler:
+    def __init__(self, build_conf, plan):
+        self.config = build_conf
+        self.nodes = {}
+        self.ready = []
+        # Packages whose tests failed after they were installed
+        self.test_failures = []
+        self.order = list(plan.order)
+        for name in plan.order:
+            node = Node(name, plan.packages[name])
+            node.waiting = len(plan.deps[name])
+            self.nodes[name] = node
+            for d in plan.deps[name]:
+                self.nodes[d].dependents.append(node)
+        pkgbuilder.skips += len(plan.installed)
+        pkgbuilder.failures += len(plan.missing) + len(plan.cancelled)
+        for name in plan.installed:
+            self.__result(name, 'installed')
+        for name in plan.missing:
+            self.__result(name, 'missing')
+        for name in plan.cancelled:
+            self.__result(name, 'cancelled')
+
+    # Record the state of a package in the report and the build journal
+    def __result(self, name, value, pkg=None):
+        metrics.result(name, value)
+        if journal.journal is not None:
+            journal.journal.record(name, value, pkg)
+
+    # Carry over the states recorded in the session being resumed. Packages
+    # completed in it are not built again, and neither are packages that
+    # failed in it unless they are retried.
+    def resume(self, retry_failed=False):
+        for name in self.order:
+            node = self.nodes[name]
+            if node.state != PENDING:
+                continue
+            state = journal.journal.state(name, node.pkg)
+            if state in journal.COMPLETED:
+                node.state = DONE
+                pkgbuilder.skips += 1
+                metrics.result(name, 'resumed')
+                for dnode in node.dependents:
+                    dnode.waiting -= 1
+            elif state == 'failed' and not retry_failed:
+                node.state = FAILED
+                pkgbuilder.failures += 1
+                metrics.result(name, 'failed')
+                console.warn('package `%s\' failed in an earlier run' % name)
+                self.__cancel(node, name)
+
+    # Packages that still need to be built
+    def packages(self):
+        return [n.pkg for n in self.nodes.values() if n.state == PENDING]
+
+    def __cancel(self, node, cause):
+        for dnode in node.dependents:
+            if dnode.state != PENDING:
+                continue
+            dnode.state = FAILED
+            pkgbuilder.failures += 1
+            self.__result(dnode.name, 'cancelled', dnode.pkg)
+            console.warn('package `%s\' cancelled, dependency `%s\' failed' %
+                         (dnode.name, cause))
+            self.__cancel(dnode, cause)
+
+    def __finish(self, node, ok):
+        if not ok:
+            node.state = FAILED
+            pkgbuilder.failures += 1
+            self.__result(node.name, 'failed', node.pkg)
+            console.warn('package `%s\' failed to build' % node.name)
+            self.__cancel(node, node.name)
+            if not self.config.keep_going:
+                self.__abort('package `%s\' failed' % node.name)
+            return
+        node.state = DONE
+        pkgbuilder.successes += 1
+        self.__result(node.name, 'succeeded', node.pkg)
+        for dnode in node.dependents:
+            dnode.waiting -= 1
+            if dnode.state == PENDING and dnode.waiting == 0:
+                self.ready.append(dnode)
+
+    # Stop building packages that have not been started yet
+    def __abort(self, reason):
+        pending = [n for n in self.nodes.values() if n.state == PENDING]
+        for node in pending:
+            node.state = FAILED
+            pkgbuilder.failures += 1
+            self.__result(node.name, 'cancelled', node.pkg)
+        self.ready = []
+        if pending:
+            console.warn('%d packages cancelled, %s' % (len(pending), reason))
+
+    # Handle a package whose tests failed after it was installed
+    def __test_failed(self, node):
+        self.test_failures.append(node.name)
+        metrics.annotate(node.name, 'tests', 'failed')
+        console.warn('tests of package `%s\' failed' % node.name)
+        if self.config.abort_on_test_failure:
+            self.__abort('tests of `%s\' failed' % node.name)
+
+    def run(self):
+        self.ready = [n for n in self.nodes.values()
+                      if n.state == PENDING and n.waiting == 0]
+        jobs = {}
+        installs = {}
+        # A package stops counting towards the limit of packages built in
+        # parallel once it is installed, even if its tests are still running
+        building = 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(self.nodes))) as executor:
+            while self.ready or jobs:
+                while self.ready and \
+                      building < self.config.max_parallel_packages:
+                    node = self.ready.pop(0)
+                    node.state = RUNNING
+                    building += 1
+                    self.__result(node.name, 'running', node.pkg)
+                    print('Starting build of ' + node.pkg.fullname)
+                    node.installed = concurrent.futures.Future()
+                    installs[node.installed] = node
+                    installed = functools.partial(node.installed.set_result,
+                                                  None)
+                    jobs[executor.submit(node.pkg.run, installed)] = node
+                done, _ = concurrent.futures.wait(
+                    list(jobs) + list(installs),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in [f for f in done if f in installs]:
+                    node = installs.pop(future)
+                    building -= 1
+                    self.__finish(node, True)
+                for future in [f for f in done if f in jobs]:
+                    node = jobs.pop(future)
+                    try:
+                        future.result()
+                    except (ValueError, OSError,
+                            subprocess.CalledProcessError) as e:
+                        # Errors such as a full disk only fail the package
+                        # that ran into them
+                        if isinstance(e, OSError):
+                            console.warn('package `%s\': %s' % (node.name, e))
+                        if node.state == DONE:
+                            self.__test_failed(node)
+                            continue
+                        installs.pop(node.installed)
+                        building -= 1
+                        self.__finish(node, False)
+                    else:
+                        if node.state != DONE:
+                            installs.pop(node.installed)
+                            building -= 1
+                            self.__finish(node, True)
@@ -0,0 +1,112 @@
+# staging.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tarfile
+import zlib
+
+def is_empty(stagedir):
+    for root, dirs, files in os.walk(stagedir):
+        if files:
+            return False
+        for d in dirs:
+            if os.path.islink(os.path.join(root, d)):
+                return False
+    return True
+
+# Pack a staged installation into a compressed tarball
+def pack(stagedir, path):
+    tmp = path + '.tmp'
+    with tarfile.open(tmp, 'w:gz') as f:
+        for name in sorted(os.listdir(stagedir)):
+            f.add(os.path.join(stagedir, name), name)
+    os.replace(tmp, path)
+
+# Raises ValueError if the archive is corrupt
+def unpack(path, stagedir):
+    try:
+        with tarfile.open(path) as f:
+            f.extractall(stagedir)
+    except (tarfile.TarError, EOFError, zlib.error) as e:
+        raise ValueError('corrupt archive `%s\': %s' % (path, e))
+    except OSError as e:
+        # Errors in the gzip format are the ones without an error number
+        if e.errno is not None:
+            raise
+        raise ValueError('corrupt archive `%s\': %s' % (path, e))
+
+# Move a staged installation into the root filesystem. The slow part of
+# copying files across filesystems is done by prepare() without holding any
+# lock, so that only the renames done by commit() need to be serialized with
+# other installations.
+class Merge:
+    def __init__(self, stagedir, tag, root='/'):
+        self.stagedir = stagedir
+        self.tag = tag
+        self.root = root
+        # Pairs of files to rename and their destination
+        self.moves = []
+        self.temps = []
+
+    def target(self, path):
+        rel = os.path.relpath(path, self.stagedir)
+        return os.path.normpath(os.path.join(self.root, rel))
+
+    # Create the directories of a staged installation and bring its files
+    # onto the filesystems they are installed to, so that putting them in
+    # place only needs renames. Files on another filesystem than the staging
+    # directory are copied next to their destination under a temporary name.
+    def prepare(self):
+        stage_dev = os.lstat(self.stagedir).st_dev
+        for d, dirs, files in os.walk(self.stagedir):
+            dest = self.target(d)
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                raise ValueError('cannot install directory %s over a file' %
+                                 dest)
+            os.makedirs(dest, exist_ok=True)
+            same_dev = os.stat(dest).st_dev == stage_dev
+            for name in files + [x for x in dirs
+                                 if os.path.islink(os.path.join(d, x))]:
+                src = os.path.join(d, name)
+                target = os.path.join(dest, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    raise ValueError('cannot install file %s over a '
+                                     'directory' % target)
+                if not same_dev:
+                    tmp = os.path.join(dest, '.%s.%s' % (name, self.tag))
+                    if os.path.lexists(tmp):
+                        os.unlink(tmp)
+                    self.temps.append(tmp)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), tmp)
+                    else:
+                        shutil.copy2(src, tmp)
+                    src = tmp
+                self.moves.append((src, target))
+
+    # Put every file in place, each one replacing any file already there
+    # atomically
+    def commit(self):
+        for src, target in self.moves:
+            os.replace(src, target)
+        self.temps = []
+
+    def abort(self):
+        for tmp in self.temps:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+        self.temps = []
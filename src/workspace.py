@@ -0,0 +1,273 @@
+# workspace.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import extract
+import fetcher
+import hashlib
+import logs
+import os
+import shutil
+import staging
+import threading
+
+# Files in the work directory of a package that are kept when its tree is
+# cleaned up, so that rebuilding it does not need to download anything and
+# later phases can still tell what changed
+KEEP = ['archive', 'archive.part', '.stamps', '.variants', 'build.log',
+        'build.log.gz', 'ccache-stats.log', 'tree.tar.gz']
+
+# Compressed copy of a tree cleaned up with `workspace_cleanup = compress'
+TREE_ARCHIVE = 'tree.tar.gz'
+
+# Assumed ratio of the size of an extracted and built tree to the size of its
+# archive, used for packages that have not been built before
+TREE_RATIO = 8
+
+# When a package fails in the scratch directory with less free space than
+# this, it is built again on disk
+SPILL_FREE = 64 << 20
+
+scratch = None
+scratch_size = 0
+workspace_size = 0
+cleanup_mode = 'remove'
+
+lock = threading.Lock()
+# Packages being built, whose trees must not be cleaned up, once for each
+# variant being built
+active = []
+# Space reserved in the scratch directory by each package placed there
+reserved = {}
+
+def is_kept(name):
+    return name in KEEP or name.startswith('.extract')
+
+def tree_size(workdir):
+    total = 0
+    try:
+        names = os.listdir(workdir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if is_kept(name):
+            continue
+        path = os.path.join(workdir, name)
+        if not os.path.isdir(path) or os.path.islink(path):
+            total += os.lstat(path).st_size
+            continue
+        for root, dirs, files in os.walk(path):
+            for f in files + [d for d in dirs
+                              if os.path.islink(os.path.join(root, d))]:
+                total += os.lstat(os.path.join(root, f)).st_size
+    return total
+
+def has_tree(workdir):
+    try:
+        return any(not is_kept(name) and name != 'stage'
+                   for name in os.listdir(workdir))
+    except FileNotFoundError:
+        return False
+
+def remove_tree(workdir):
+    for name in os.listdir(workdir):
+        if is_kept(name):
+            continue
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+def compress_tree(workdir):
+    tmp = os.path.join(workdir, '.tree')
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+    for name in os.listdir(workdir):
+        if not is_kept(name) and name != '.tree':
+            os.rename(os.path.join(workdir, name), os.path.join(tmp, name))
+    staging.pack(tmp, os.path.join(workdir, TREE_ARCHIVE))
+    shutil.rmtree(tmp)
+
+def scratch_dir(pkg):
+    return os.path.join(scratch, pkg.name)
+
+# Size of the tree of a package recorded when it was last built, or `disk'
+# if it did not fit in the scratch directory
+def recorded_size(pkg):
+    try:
+        with open(os.path.join(pkg.workdir, '.stamps', 'tree-size')) as f:
+            value = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return value if value == 'disk' else int(value)
+
+def record_size(pkg, value):
+    stamps = os.path.join(pkg.workdir, '.stamps')
+    os.makedirs(stamps, exist_ok=True)
+    with open(os.path.join(stamps, 'tree-size'), 'w') as f:
+        f.write(str(value))
+
+def scratch_used():
+    total = 0
+    for name in os.listdir(scratch):
+        if name in reserved:
+            total += reserved[name]
+        else:
+            total += tree_size(os.path.join(scratch, name))
+    return total
+
+# Remove the least recently used trees of finished packages from the
+# scratch directory until `size' more bytes fit in its budget
+def make_room(size):
+    used = scratch_used()
+    if used + size <= scratch_size:
+        return True
+    trees = []
+    for name in os.listdir(scratch):
+        if name in active or name in reserved:
+            continue
+        path = os.path.join(scratch, name)
+        trees.append((os.stat(path).st_mtime, name, path))
+    for mtime, name, path in sorted(trees):
+        used -= tree_size(path)
+        shutil.rmtree(path)
+        if used + size <= scratch_size:
+            return True
+    return False
+
+# Choose where the extracted sources and build directory of a package go.
+# An existing tree is reused where it is, otherwise the tree goes in the
+# scratch directory if its expected size fits in the budget.
+def place(pkg):
+    archive = os.path.join(pkg.workdir, TREE_ARCHIVE)
+    if os.path.isfile(archive):
+        logs.status('Restoring build tree of %s-%s' %
+                    (pkg.name, pkg.version))
+        extract.extract_archive(archive, pkg.workdir)
+        os.unlink(archive)
+        return pkg.workdir
+    if scratch is None or has_tree(pkg.workdir):
+        return pkg.workdir
+    path = scratch_dir(pkg)
+    if os.path.isdir(path):
+        reserved[pkg.name] = max(tree_size(path), recorded_size(pkg) or 0)
+        return path
+    size = recorded_size(pkg)
+    if size == 'disk':
+        return pkg.workdir
+    if size is None:
+        size = os.path.getsize(os.path.join(pkg.workdir, 'archive')) * \
+            TREE_RATIO
+    if not make_room(size):
+        return pkg.workdir
+    reserved[pkg.name] = size
+    os.makedirs(path)
+    return path
+
+# Build a package in the tree chosen for it, then clean up the trees of
+# finished packages that no longer fit in the workspace budget
+@contextlib.contextmanager
+def tree(pkg):
+    with lock:
+        active.append(pkg.name)
+        pkg.set_treedir(place(pkg))
+    try:
+        yield
+    finally:
+        with lock:
+            active.remove(pkg.name)
+            if pkg.name not in active:
+                reserved.pop(pkg.name, None)
+            if pkg.treedir != pkg.workdir and os.path.isdir(pkg.treedir):
+                size = tree_size(pkg.treedir)
+                if recorded_size(pkg) != 'disk':
+                    record_size(pkg, size)
+                # Mark the tree as recently used
+                os.utime(pkg.treedir)
+            elif has_tree(pkg.workdir):
+                os.utime(pkg.workdir)
+            cleanup()
+
+# Move a package that failed in a full scratch directory back to disk,
+# returning whether it should be built again
+def spill(pkg):
+    if pkg.treedir == pkg.workdir:
+        return False
+    # Other variants are still building in the tree
+    if active.count(pkg.name) > 1:
+        return False
+    if shutil.disk_usage(scratch).free >= SPILL_FREE:
+        return False
+    logs.status('Scratch directory is full, building %s on disk' %
+                pkg.fullname)
+    with lock:
+        shutil.rmtree(pkg.treedir)
+        reserved.pop(pkg.name, None)
+        record_size(pkg, 'disk')
+        pkg.set_treedir(pkg.workdir)
+    return True
+
+# Clean up the least recently used trees of finished packages in the build
+# directory until they fit in the workspace budget, keeping their archives
+# and stamps. Returns the number of trees cleaned up and bytes freed.
+def cleanup():
+    if not workspace_size:
+        return 0, 0
+    trees = []
+    for name in os.listdir('.'):
+        if name in active or not os.path.isdir(name) or \
+           os.path.islink(name) or not os.path.isdir(os.path.join(name,
+                                                                  '.stamps')):
+            continue
+        size = tree_size(name)
+        if size:
+            trees.append((os.stat(name).st_mtime, size, name))
+    total = sum(t[1] for t in trees)
+    cleaned = 0
+    freed = 0
+    for mtime, size, name in sorted(trees):
+        if total <= workspace_size:
+            break
+        if cleanup_mode == 'compress':
+            compress_tree(name)
+            size -= os.path.getsize(os.path.join(name, TREE_ARCHIVE))
+        else:
+            remove_tree(name)
+        total -= size
+        cleaned += 1
+        freed += size
+    if cleaned:
+        print('Cleaned up %d build trees, freed %s' %
+              (cleaned, fetcher.format_size(freed)))
+    return cleaned, freed
+
+def setup(build_conf):
+    global scratch, scratch_size, workspace_size, cleanup_mode
+    workspace_size = build_conf.workspace_size
+    cleanup_mode = build_conf.workspace_cleanup
+    if not build_conf.scratch_dir:
+        return
+    # Keep the trees of different build directories apart
+    key = hashlib.sha256(os.getcwd().encode()).hexdigest()[:16]
+    scratch = os.path.join(os.path.expanduser(build_conf.scratch_dir),
+                           'gnukit-' + key)
+    os.makedirs(scratch, exist_ok=True)
+    scratch_size = build_conf.scratch_size
+    if not scratch_size:
+        usage = shutil.disk_usage(scratch)
+        scratch_size = scratch_used() + usage.free * 9 // 10
@@ -0,0 +1,93 @@
+# test_cli.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import build
+
+def parse(*argv):
+    return build.make_parser().parse_args(build.normalize_args(list(argv)))
+
+class CommandLineTest(unittest.TestCase):
+    def test_command_first(self):
+        args = parse('plan', '--json', 'bash')
+        self.assertEqual(args.command, 'plan')
+        self.assertTrue(args.json)
+        self.assertEqual(args.packages, ['bash'])
+
+    def test_options_before_command(self):
+        args = parse('--json', 'plan')
+        self.assertEqual(args.command, 'plan')
+        self.assertTrue(args.json)
+        self.assertEqual(args.packages, [])
+        args = parse('--yes', 'fetch', 'bash')
+        self.assertEqual(args.command, 'fetch')
+        self.assertTrue(args.yes)
+        self.assertEqual(args.packages, ['bash'])
+        args = parse('-v', 'build')
+        self.assertEqual(args.command, 'build')
+        self.assertTrue(args.verbose)
+        self.assertEqual(args.packages, [])
+        args = parse('--json', 'status')
+        self.assertEqual(args.command, 'status')
+        self.assertTrue(args.json)
+
+    def test_define_before_command(self):
+        args = parse('-D', 'jobs=8', 'plan')
+        self.assertEqual(args.command, 'plan')
+        self.assertEqual(args.define, [('', 'jobs', '8')])
+        self.assertEqual(args.packages, [])
+        args = parse('-Djobs=8', '--define', 'InstallDirs.prefix=/opt',
+                     'status')
+        self.assertEqual(args.command, 'status')
+        self.assertEqual(args.define, [('', 'jobs', '8'),
+                                       ('InstallDirs', 'prefix', '/opt')])
+
+    def test_define_value_named_like_command(self):
+        self.assertEqual(build.normalize_args(['-D', 'plan', 'status']),
+                         ['status', '-D', 'plan'])
+
+    def test_default_command(self):
+        args = parse()
+        self.assertEqual(args.command, 'build')
+        args = parse('-y', 'bash', 'make')
+        self.assertEqual(args.command, 'build')
+        self.assertTrue(args.yes)
+        self.assertEqual(args.packages, ['bash', 'make'])
+        args = parse('-D', 'jobs=2', 'bash')
+        self.assertEqual(args.command, 'build')
+        self.assertEqual(args.packages, ['bash'])
+
+    def test_packages_after_separator(self):
+        args = parse('--', 'plan')
+        self.assertEqual(args.command, 'build')
+        self.assertEqual(args.packages, ['plan'])
+
+    def test_legacy_options(self):
+        args = parse('--json', '--plan', 'bash')
+        self.assertEqual(args.command, 'plan')
+        self.assertTrue(args.json)
+        self.assertEqual(args.packages, ['bash'])
+        args = parse('--uninstall', 'bash')
+        self.assertEqual(args.command, 'uninstall')
+        self.assertEqual(args.packages, ['bash'])
+
+if __name__ == '__main__':
+    unittest.main()
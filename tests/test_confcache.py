@@ -0,0 +1,106 @@
+# test_confcache.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import confcache
+
+def build_conf(**kwargs):
+    values = {
+        'build': 'x86_64-pc-linux-gnu',
+        'host': 'x86_64-pc-linux-gnu',
+        'target': 'x86_64-pc-linux-gnu',
+        'variant_configure_args': ''
+    }
+    values.update(kwargs)
+    return types.SimpleNamespace(**values)
+
+class CacheKeyTest(unittest.TestCase):
+    def key(self, env={}, pkg_env={}, **kwargs):
+        return confcache.cache_key(build_conf(**kwargs), env, pkg_env)
+
+    def test_default_compilers(self):
+        self.assertEqual(self.key(), self.key())
+        self.assertEqual(len(self.key()), 16)
+
+    def test_environment(self):
+        self.assertNotEqual(self.key(), self.key({'CFLAGS': '-O2'}))
+        self.assertNotEqual(self.key(), self.key({'CC': 'no-such-cc'}))
+        self.assertNotEqual(self.key(), self.key({'FOO': '1'}, {'FOO': '1'}))
+        # Only the variables of the package and precious ones count
+        self.assertEqual(self.key(), self.key({'FOO': '1'}))
+
+    def test_triplets(self):
+        self.assertNotEqual(self.key(), self.key(host='aarch64-linux-gnu'))
+        self.assertNotEqual(self.key(),
+                            self.key(variant_configure_args='CFLAGS=-g'))
+
+    def test_compiler_cache(self):
+        # The compiler is identified without the compiler cache running it
+        self.assertEqual(confcache.compiler_id('ccache no-such-cc'),
+                         confcache.compiler_id('no-such-cc'))
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        self.cache = confcache.ConfigCache('key')
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_merge(self):
+        self.write('first', '# header\n'
+                   'ac_cv_func_foo=${ac_cv_func_foo=yes}\n'
+                   'ac_cv_env_CC_value=gcc\n')
+        self.cache.merge('first')
+        self.write('second', '# header\n'
+                   'ac_cv_func_foo=${ac_cv_func_foo=no}\n'
+                   'ac_cv_prog_bar=${ac_cv_prog_bar=\'a\n'
+                   'b\'}\n')
+        self.cache.merge('second')
+        self.assertEqual(self.read(self.cache.path),
+                         '# header\n'
+                         'ac_cv_func_foo=${ac_cv_func_foo=yes}\n'
+                         'ac_cv_prog_bar=${ac_cv_prog_bar=\'a\n'
+                         'b\'}\n')
+
+    def test_copy_to(self):
+        self.write('dest', 'stale\n')
+        self.cache.copy_to('dest')
+        self.assertFalse(os.path.exists('dest'))
+        self.write('first', 'ac_cv_func_foo=${ac_cv_func_foo=yes}\n')
+        self.cache.merge('first')
+        self.cache.copy_to('dest')
+        self.assertEqual(self.read('dest'),
+                         'ac_cv_func_foo=${ac_cv_func_foo=yes}\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# test_fetcher.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import hashlib
+import http.server
+import io
+import os
+import re
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import fetcher
+
+DATA = bytes(range(256)) * 1024
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+# Serves DATA with support for range requests. Each entry of `faults' is
+# used up by one request: `cut' sends only half of what was asked for
+# before closing the connection, and `garbage' answers with an invalid
+# status line.
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        fault = self.server.faults.pop(0) if self.server.faults else None
+        if fault == 'garbage':
+            self.wfile.write(b'garbage\r\n\r\n')
+            self.close_connection = True
+            return
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        body = DATA[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if fault == 'cut':
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.faults = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/archive' % self.server.server_port
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp.name, 'archive')
+        self.md5 = hashlib.md5(DATA).hexdigest()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmp.cleanup()
+
+    def download(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            fetcher.download(self.url, self.dest, self.md5)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def test_download(self):
+        self.download()
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume_after_cut(self):
+        self.server.faults = ['cut', 'cut']
+        self.download()
+        half = len(DATA) // 2
+        quarter = half + (len(DATA) - half) // 2
+        self.assertEqual(self.server.requests,
+                         [None, 'bytes=%d-' % half, 'bytes=%d-' % quarter])
+
+    def test_retry_after_invalid_response(self):
+        self.server.faults = ['garbage']
+        self.download()
+        self.assertEqual(self.server.requests, [None, None])
+
+    def test_resume_partial_file(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(DATA[:1000])
+        self.download()
+        self.assertEqual(self.server.requests, ['bytes=1000-'])
+
+    def test_give_up(self):
+        self.server.faults = ['cut'] * (fetcher.RETRIES + 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(ConnectionError):
+                fetcher.download(self.url, self.dest, self.md5)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertTrue(os.path.exists(self.dest + '.part'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# test_jobserver.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import jobserver
+
+class ReserveTest(unittest.TestCase):
+    def server(self, style, jobs=4, memory=0):
+        server = jobserver.Jobserver(jobs, memory, style, None)
+        self.addCleanup(os.close, server.rfd)
+        self.addCleanup(os.close, server.wfd)
+        return server
+
+    def test_shared(self):
+        server = self.server('pipe')
+        with server.reserve() as jobs:
+            self.assertEqual(len(jobs.tokens), 1)
+            self.assertIn('--jobserver-auth=', jobs.env()['MAKEFLAGS'])
+            self.assertEqual(jobs.fds(), (server.rfd, server.wfd))
+
+    def test_memory_limit(self):
+        server = self.server('pipe', memory=2 << 30)
+        with server.reserve(job_memory=1 << 30) as jobs:
+            self.assertEqual(len(jobs.tokens), 2)
+            self.assertEqual(jobs.env()['MAKEFLAGS'], '-j2')
+            self.assertEqual(jobs.ninja_args(), ['-j', '2'])
+
+    def test_ninja_takes_free_tokens(self):
+        server = self.server('pipe')
+        with server.reserve():
+            with server.reserve(ninja=True) as ninja:
+                self.assertEqual(len(ninja.tokens), 3)
+                self.assertEqual(ninja.ninja_args(), ['-j', '3'])
+            with server.reserve() as make:
+                with server.reserve(ninja=True) as ninja:
+                    self.assertEqual(ninja.ninja_args(), ['-j', '2'])
+
+    def test_ninja_fifo_shared(self):
+        server = self.server('pipe')
+        server.style = 'fifo'
+        with server.reserve(ninja=True) as jobs:
+            self.assertEqual(len(jobs.tokens), 1)
+            self.assertEqual(jobs.ninja_args(), [])
+
+    def test_off(self):
+        server = self.server('off')
+        reservations = [server.reserve() for i in range(8)]
+        for jobs in reservations:
+            self.assertEqual(jobs.tokens, b'')
+            self.assertEqual(jobs.env()['MAKEFLAGS'], '-j4')
+            self.assertEqual(jobs.ninja_args(), ['-j', '4'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# test_manifest.py -- this file is part of gnukit.
+# Copyright (C) 2020 XNSC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import manifest
+
+class RecordTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.prefix = os.path.join(self.tmp.name, 'prefix')
+        self.db = manifest.Manifest(os.path.join(self.prefix, 'var', 'lib',
+                                                 'gnukit', 'installed.db'))
+
+    def package(self, version, build_key):
+        return types.SimpleNamespace(name='hello', version=version,
+                                     build_key=build_key, dependencies=[])
+
+    # Install files into the prefix as a package would, returning them as
+    # they are recorded
+    def install(self, *names):
+        ret = []
+        for name in names:
+            path = os.path.join(self.prefix, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(name)
+            ret.append((path, manifest.file_hash(path)))
+        return ret
+
+    def test_record(self):
+        files = self.install('bin/hello', 'share/man/man1/hello.1')
+        self.db.record(self.package('1.0', 'a'), files)
+        self.assertEqual(self.db.lookup('hello'), ('1.0', 'a', []))
+        self.assertEqual(self.db.files('hello'), sorted(files))
+
+    def test_record_removes_stale_files(self):
+        old = self.install('bin/hello', 'share/hello/old.txt',
+                           'share/info/dir')
+        self.db.record(self.package('1.0', 'a'), old)
+        new = self.install('bin/hello', 'share/hello/new.txt')
+        self.db.record(self.package('2.0', 'b'), new)
+        self.assertEqual(self.db.files('hello'), sorted(new))
+        self.assertFalse(os.path.exists(os.path.join(self.prefix, 'share',
+                                                     'hello', 'old.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.prefix, 'share',
+                                                    'info', 'dir')))
+        for path, h in new:
+            self.assertTrue(os.path.exists(path))
+
+    # A package that ignored DESTDIR installed straight into the prefix, so
+    # the files of its previous version must be left alone
+    def test_record_without_files(self):
+        files = self.install('bin/hello', 'share/hello/data.txt')
+        self.db.record(self.package('1.0', 'a'), files)
+        self.install('bin/hello', 'share/hello/data.txt')
+        self.db.record(self.package('2.0', 'b'))
+        self.assertEqual(self.db.lookup('hello'), ('2.0', 'b', []))
+        self.assertEqual(self.db.files('hello'), sorted(files))
+        for path, h in files:
+            self.assertTrue(os.path.exists(path))
+
+    def test_record_first_install_without_files(self):
+        self.db.record(self.package('1.0', 'a'))
+        self.assertEqual(self.db.lookup('hello'), ('1.0', 'a', []))
+        self.assertEqual(self.db.files('hello'), [])
+
+if __name__ == '__main__':
+    unittest.main()